@@ -0,0 +1,189 @@
+import hashlib
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ArchiveError(Exception):
+    """An uploaded archive is corrupt, unsafe, or too big.
+    """
+
+
+def common_prefix(names):
+    """If all the entries in an archive are inside a single top-level
+    directory, get that directory's name (with a trailing slash).
+    Otherwise, return an empty string.
+    """
+    tops = {name.split('/', 1)[0] for name in names}
+    if len(tops) == 1 and all('/' in name for name in names):
+        return tops.pop() + '/'
+    return ''
+
+
+def _target(dest, name, prefix):
+    """Get the path to extract an archive entry to, with the common
+    prefix stripped. Return None for the prefix directory itself. Raise
+    an `ArchiveError` for entries that would land outside `dest`.
+    """
+    parts = name.replace('\\', '/').split('/')
+    if name.startswith('/') or '..' in parts or \
+            re.match(r'[A-Za-z]:', name):
+        raise ArchiveError('unsafe path in archive: {}'.format(name))
+    rel = name[len(prefix):]
+    if not rel:
+        return None
+    return os.path.join(dest, *[p for p in rel.split('/') if p])
+
+
+def _check_conflicts(infos, prefix):
+    """Raise an `ArchiveError` if two entries of an archive would be
+    extracted to the same path as a file and as a directory (e.g., a
+    file `a` along with `a/b`).
+    """
+    files = set()
+    dirs = set()
+    for info in infos:
+        target = _target('', info.filename, prefix)
+        if target is None:
+            continue
+        parent = os.path.dirname(target)
+        while parent:
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+        (dirs if info.is_dir() else files).add(target)
+    conflicts = files & dirs
+    if conflicts:
+        raise ArchiveError('conflicting entries in archive: {}'.format(
+            min(conflicts)
+        ))
+
+
+class HashingFile:
+    """A temporary file in `dirname` that computes the SHA-256 hash of
+    the data written to it, for receiving uploads. It is removed when it
+    is closed.
+    """
+    def __init__(self, dirname):
+        self.file = tempfile.NamedTemporaryFile(dir=dirname, prefix='upload-')
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def check(zf, max_files, max_size):
+    """Check an open archive's central directory against the limits on
+    the number of entries and their total (uncompressed) size. Return
+    its entries.
+    """
+    infos = zf.infolist()
+    if len(infos) > max_files:
+        raise ArchiveError('archive has too many files ({} > {})'.format(
+            len(infos), max_files,
+        ))
+    total = sum(info.file_size for info in infos)
+    if total > max_size:
+        raise ArchiveError('archive is too big ({} > {} bytes)'.format(
+            total, max_size,
+        ))
+    return infos
+
+
+def validate(path, max_files, max_size):
+    """Check that a file is a zip archive within the limits on the number
+    of files and their total size, and that all of its entries can be
+    extracted safely and without conflicts. Only the central directory
+    is read. Return the total uncompressed size.
+
+    Raise an `ArchiveError` if the archive is invalid.
+    """
+    try:
+        with zipfile.ZipFile(path) as zf:
+            infos = check(zf, max_files, max_size)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError) as exc:
+        raise ArchiveError('bad archive: {}'.format(exc))
+    _check_conflicts(infos, common_prefix([info.filename for info in infos]))
+    return sum(info.file_size for info in infos)
+
+
+def _extract_file(zf, info, target):
+    """Write one archive entry to disk, keeping its permission bits.
+    """
+    with zf.open(info) as src, open(target, 'wb') as dest:
+        shutil.copyfileobj(src, dest, 1024 * 1024)
+    mode = (info.external_attr >> 16) & 0o777
+    if mode and not stat.S_ISLNK(info.external_attr >> 16):
+        os.chmod(target, mode)
+
+
+def extract(path, dest, max_files, max_size, threads=1):
+    """Extract a zip archive into the directory `dest`, which is created.
+    If all the entries are in one top-level directory, that directory is
+    stripped. Return the stripped prefix (or an empty string).
+
+    If `threads` is more than 1, files are written in parallel.
+
+    Raise an `ArchiveError` if the archive is corrupt, has entries that
+    would be extracted outside of `dest`, or exceeds the limits on the
+    number of files and their total size, or if its entries conflict
+    (e.g., a file and a directory with the same path).
+    """
+    try:
+        with zipfile.ZipFile(path) as zf:
+            infos = check(zf, max_files, max_size)
+            prefix = common_prefix([info.filename for info in infos])
+            _check_conflicts(infos, prefix)
+
+            # Plan the extraction and create the directories first.
+            os.mkdir(dest)
+            files = []
+            for info in infos:
+                target = _target(dest, info.filename, prefix)
+                if target is None:
+                    continue
+                if info.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    files.append((info, target))
+
+            if threads > 1 and len(files) > 1:
+                # Each thread reads through its own handle on the archive.
+                local = threading.local()
+                handles = []
+
+                def extract_one(item):
+                    if not hasattr(local, 'zf'):
+                        local.zf = zipfile.ZipFile(path)
+                        handles.append(local.zf)
+                    _extract_file(local.zf, *item)
+
+                try:
+                    with ThreadPoolExecutor(threads) as pool:
+                        list(pool.map(extract_one, files))
+                finally:
+                    for handle in handles:
+                        handle.close()
+            else:
+                for info, target in files:
+                    _extract_file(zf, info, target)
+
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError) as exc:
+        raise ArchiveError('bad archive: {}'.format(exc))
+    except (FileExistsError, IsADirectoryError, NotADirectoryError) as exc:
+        raise ArchiveError('conflicting entries in archive: {}'.format(
+            os.path.relpath(exc.filename, dest) if exc.filename else exc
+        ))
+    return prefix
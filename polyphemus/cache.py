@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from .db import _write_json
+from .workspace import clone_file, tree_size
+
+CACHE_DIR = 'cache'
+ENTRY_FILENAME = 'entry.json'
+
+# The job options that affect the build, and the configuration options
+# that identify the toolchain.
+BUILD_OPTIONS = ['estimate', 'make', 'directives', 'platform', 'mode']
+TOOLCHAIN_OPTIONS = ['TOOLCHAIN', 'BUILD_CACHE_TOOLCHAIN',
+                     'HLS_COMMAND_PREFIX', 'EXECUTABLE_NAME']
+
+# Job fields that describe a build's results (i.e., its AFI), which jobs
+# reusing the build take on too.
+RESULT_FIELDS = ['afi_id', 'agfi_id']
+
+
+def job_key(archive_digest, job_config, config):
+    """Get the cache key for a job: a hash of its archive (given as a hex
+    digest), the job options that affect its build (with defaults filled
+    in), and the toolchain identity.
+    """
+    options = {k: job_config.get(k) for k in BUILD_OPTIONS}
+    options['platform'] = options['platform'] or config['DEFAULT_PLATFORM']
+    options['mode'] = options['mode'] or config['DEFAULT_F1_MODE']
+    options['estimate'] = bool(options['estimate'])
+    options['make'] = bool(options['make'])
+    toolchain = {k: config[k] for k in TOOLCHAIN_OPTIONS}
+
+    h = hashlib.sha256(archive_digest.encode('ascii'))
+    h.update(json.dumps([options, toolchain], sort_keys=True).encode('utf8'))
+    return h.hexdigest()
+
+
+class BuildCache:
+    """A cache of build results (the contents of the code directory after
+    a successful build, its make configuration, and the state it leads
+    to), keyed by the hash of each job's archive and build options (see
+    `job_key`). Lets identical jobs skip straight past their builds.
+
+    The cache holds at most `budget` bytes; the least recently used
+    results are evicted first. Files and directories matching the
+    `exclude` patterns (e.g., intermediate build products) are not
+    cached.
+    """
+    def __init__(self, path, budget, exclude=()):
+        self.path = path
+        self.budget = budget
+        self.exclude = exclude
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def open(cls, db, config):
+        """Get the build cache for a job database's instance directory,
+        or None if it is disabled.
+        """
+        if not config['BUILD_CACHE_SIZE']:
+            return None
+        return cls(os.path.join(db.base_path, CACHE_DIR),
+                   config['BUILD_CACHE_SIZE'] * 1024 ** 3,
+                   config['BUILD_CACHE_EXCLUDE'])
+
+    def _entry_dir(self, key):
+        return os.path.join(self.path, key)
+
+    def _read_entry(self, key):
+        """Read a cache entry's metadata, or return None if there is no
+        such entry.
+        """
+        try:
+            with open(os.path.join(self._entry_dir(key), ENTRY_FILENAME)) \
+                    as f:
+                return json.load(f)
+        except (IOError, json.JSONDecodeError):
+            return None
+
+    def _write_entry(self, entry_dir, entry):
+        _write_json(os.path.join(entry_dir, ENTRY_FILENAME), entry)
+
+    def has(self, key):
+        """Check whether the cache has results for a key.
+        """
+        return self._read_entry(key) is not None
+
+    def restore(self, task):
+        """Copy cached build results for a job into its code directory.
+        Return the state the job should move to, or None if there are no
+        cached results for it.
+        """
+        key = task['config'].get('cache_key')
+        entry = self._read_entry(key) if key else None
+        if not entry:
+            return None
+
+        try:
+            shutil.copytree(os.path.join(self._entry_dir(key), 'code'),
+                            task.code_dir, symlinks=True,
+                            copy_function=clone_file)
+        except (OSError, shutil.Error):
+            # The entry was evicted while we were copying it.
+            shutil.rmtree(task.code_dir, ignore_errors=True)
+            return None
+
+        if entry.get('make_conf') is not None:
+            task['config']['make_conf'] = entry['make_conf']
+        task.job.update(entry.get('results') or {})
+        task.log('reused build results of job {} from the build cache'.format(
+            entry['job']
+        ))
+
+        entry['used'] = time.time()
+        try:
+            self._write_entry(self._entry_dir(key), entry)
+        except OSError:
+            pass
+        return entry['state']
+
+    def store(self, task, next_state):
+        """Add a job's build results to the cache, recording that they
+        lead to `next_state`. Then evict old results to stay within the
+        budget.
+        """
+        key = task['config'].get('cache_key')
+        if not key or os.path.isdir(self._entry_dir(key)):
+            return
+
+        # Build the entry in a temporary directory and then move it into
+        # place, so readers never see a partial entry.
+        tmp_dir = os.path.join(self.path, '.{}.{}.{}.tmp'.format(
+            key, os.getpid(), threading.get_ident()
+        ))
+        try:
+            shutil.copytree(task.code_dir, os.path.join(tmp_dir, 'code'),
+                            symlinks=True, copy_function=clone_file,
+                            ignore=shutil.ignore_patterns(*self.exclude))
+            now = time.time()
+            self._write_entry(tmp_dir, {
+                'job': task['name'],
+                'state': next_state,
+                'make_conf': task['config'].get('make_conf'),
+                'results': {k: task.job[k] for k in RESULT_FIELDS
+                            if task.job.get(k)},
+                'size': tree_size(tmp_dir),
+                'created': now,
+                'used': now,
+            })
+            os.rename(tmp_dir, self._entry_dir(key))
+        except (OSError, shutil.Error) as exc:
+            task.log('could not cache build results: {}'.format(exc))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        task.log('cached build results')
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        its budget.
+        """
+        entries = []
+        for key in os.listdir(self.path):
+            entry = None if key.startswith('.') else self._read_entry(key)
+            if entry:
+                entries.append((entry['used'], entry['size'], key))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.budget:
+                break
+            # Move the entry out of the way first, so it disappears
+            # all at once.
+            doomed = os.path.join(self.path, '.{}.evicted'.format(key))
+            try:
+                os.rename(self._entry_dir(key), doomed)
+            except OSError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
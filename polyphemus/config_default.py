@@ -7,12 +7,33 @@ GH_REPO = "https://github.com/cucapra/polyphemus"
 # The extensions to allow for uploaded code archives.
 UPLOAD_EXTENSIONS = ['zip']
 
+# Limits on the number of files in an uploaded archive and their total
+# (uncompressed) size in bytes. Archives of at least UNPACK_PARALLEL_SIZE
+# bytes are extracted with UNPACK_THREADS threads.
+UNPACK_MAX_FILES = 100000
+UNPACK_MAX_SIZE = 4 * 1024 ** 3
+UNPACK_THREADS = 4
+UNPACK_PARALLEL_SIZE = 64 * 1024 ** 2
+
+# Archives of at most this many (uncompressed) bytes are extracted as soon
+# as they are uploaded, so their jobs skip the unpack stage.
+UPLOAD_EXTRACT_SIZE = 16 * 1024 ** 2
+
 # A prefix command to use *before* the invocations of Xilinx tools. For
 # example, if your deployment needs to execute the Xilinx tools on a different
 # machine or a different Docker container, a deployment could use this prefix
 # to send these commands there.
 HLS_COMMAND_PREFIX = []
 
+# The backend for storing job metadata. The default ("json") keeps an
+# `info.json` file in each job's directory. Set this to "sqlite" to keep job
+# metadata in a SQLite database in the instance directory instead, which is
+# faster with many jobs and safe to share between the server and workproc
+# processes on one host. It cannot be shared between machines (e.g., over
+# NFS), because its write-ahead log needs shared memory. Use `pipenv run
+# import-jobs` to import existing jobs into it.
+DB_BACKEND = 'json'
+
 # Spawn threads inside the server process for the workers (instead of
 # using a separate worker process). The default (None) means True in the
 # development environment and False in production.
@@ -22,9 +43,62 @@ WORKER_THREADS = None
 # communication
 POLL_MODE = True
 
+# In poll mode, watch the jobs directory with inotify (on Linux) so workers
+# hear about new jobs and state changes right away. Polling then only happens
+# every `POLL_FALLBACK_INTERVAL` seconds, to catch changes inotify cannot see
+# (e.g., ones made by other machines on shared storage).
+WATCH_JOBS = True
+POLL_FALLBACK_INTERVAL = 30
+
+# In poll mode, how often (in seconds) to refresh the index of jobs by state
+# from disk. This picks up state changes made by other processes (e.g., job
+# state updates through the web interface). Only unfinished jobs, and jobs
+# whose state changed in the manifest, are re-read. Newly created jobs are
+# noticed without a refresh.
+REINDEX_INTERVAL = 60
+
+# Workers hold a lease on each job they are working on, renewed every
+# `LEASE_HEARTBEAT` seconds. If a lease is not renewed for `LEASE_TIMEOUT`
+# seconds (e.g., because its worker crashed), the job is returned to the
+# state it was acquired from so another worker can pick it up.
+LEASE_TIMEOUT = 600
+LEASE_HEARTBEAT = 60
+
 # The number of jobs to process in parallel in the "make" stage (which is the
-# expensive, long-running one).
-PARALLELISM_MAKE = 1
+# expensive, long-running one). Set this to None to decide adaptively instead:
+# a build then starts only when the host's free cores and memory can fit its
+# estimated footprint alongside the builds already running, up to
+# MAKE_MAX_BUILDS builds at once.
+PARALLELISM_MAKE = None
+MAKE_MAX_BUILDS = 8
+
+# The estimated (memory in GiB, cores) used by a build in each mode, for
+# adaptive make parallelism. Memory estimates are refined from the peaks
+# measured on the host. MAKE_MEMORY_HEADROOM GiB are always left free.
+MAKE_FOOTPRINTS = {
+    'hw': (32, 4),
+    'hw_emu': (8, 2),
+    'sw_emu': (2, 1),
+    'estimate': (4, 1),
+}
+MAKE_FOOTPRINT_DEFAULT = (8, 2)
+MAKE_MEMORY_HEADROOM = 2
+
+# Give each running make build its own set of cores (in proportion to its
+# estimated footprint), pass a matching `-j` to make, and redistribute the
+# cores when builds finish. If MAKE_CGROUP is the path of a cgroup v2
+# directory that the workers may write to, each build also runs in its own
+# child cgroup there, limited to its cores and estimated memory.
+MAKE_PIN_CORES = True
+MAKE_CGROUP = None
+
+# Make slots are shared fairly between submitters. Nobody gets more than
+# MAKE_SHARE_CAP slots at once (0 means no cap), and when several
+# submitters are waiting, they take turns, starting with whoever is using
+# the fewest slots relative to their weight in MAKE_SHARE_WEIGHTS (a dict
+# mapping submitters to weights, default 1).
+MAKE_SHARE_CAP = 0
+MAKE_SHARE_WEIGHTS = {}
 
 # Filename extensions to send as plain text for job file viewing.
 TEXT_EXTENSIONS = [
@@ -44,6 +118,9 @@ TEXT_EXTENSIONS = [
 def str_to_bool(x):
     return not (x == '0' or x == '')
 
+def str_to_int(x):
+    return int(x) if x else 0
+
 # Configuration options allowed during job creation. Each option has a
 # conversion function (i.e., type) used to translate the request value.
 CONFIG_OPTIONS = {
@@ -54,14 +131,80 @@ CONFIG_OPTIONS = {
     'hwname': str,
     'platform': str,
     'mode': str,
+    'priority': str_to_int,
+    'submitter': str,
+    'parent': str,
 }
 
+# The request header identifying who submitted a job, used when the
+# `submitter` option is not given. Without either, jobs are attributed to
+# the client's address.
+SUBMITTER_HEADER = 'X-Submitter'
+
 # The name to use for compiled executables.
 EXECUTABLE_NAME = 'exe'
 
+# Hardware builds on F1 run in a workspace under SCRATCH_ROOT (e.g., on an
+# NVMe drive or a tmpfs). Files are copied there as reflinks where the
+# filesystem allows it, then as hard links (if SCRATCH_HARDLINK is set and
+# the root is on the same filesystem as the instance directory), and as
+# plain copies otherwise. Builds run in place if the root would have less
+# than SCRATCH_MIN_FREE GiB free after copying the job's files.
+SCRATCH_ROOT = '_local_instance'
+SCRATCH_MIN_FREE = 20
+SCRATCH_HARDLINK = True
+
+# Jobs identical to an earlier one (the same archive, build options, and
+# toolchain) reuse its build results from a cache in the instance directory.
+# BUILD_CACHE_SIZE is the cache's disk budget in GiB (0 disables it); the
+# least recently used results are evicted first. BUILD_CACHE_TOOLCHAIN
+# identifies the installed toolchain (e.g., its version): change it after an
+# upgrade so old results are not reused. Build directory files matching
+# BUILD_CACHE_EXCLUDE are not cached.
+BUILD_CACHE_SIZE = 50
+BUILD_CACHE_TOOLCHAIN = ''
+BUILD_CACHE_EXCLUDE = ['_x', '.Xil', '.run']
+
+# Run-only jobs (with a `parent` job) reuse these build artifacts (paths in
+# the code directory) from their parent, and only run this make target to
+# build their host code.
+RUN_ONLY_ARTIFACTS = ['xclbin', 'sd_card']
+HOST_MAKE_TARGET = 'host'
+
+# When several jobs are waiting for a worker, the one with the highest
+# effective priority goes first (ties go to the oldest job). A job's
+# effective priority is its `priority` option, plus the bonus for its mode
+# here, plus one for every SCHED_AGING seconds since it was submitted (0
+# disables aging).
+SCHED_MODE_BONUS = {
+    'estimate': 2,
+    'sw_emu': 1,
+}
+SCHED_AGING = 30 * 60
+
+# The default and maximum number of jobs on each page of the job list.
+JOBS_PAGE_SIZE = 50
+JOBS_PAGE_MAX = 1000
+
 # The number of (recent) lines of the log to show on job pages.
 LOG_PREVIEW_LINES = 32
 
+# Job logs are written through a pool of buffered writers. This is the
+# maximum number of log files kept open at once, and how often (in seconds)
+# buffered log lines are written out. Logs are also written out whenever a
+# job changes state.
+LOG_POOL_SIZE = 64
+LOG_FLUSH_INTERVAL = 1.0
+
+# Logs are split into segments of about this many bytes; finished segments
+# are compressed with gzip. Set to 0 to keep each log in a single file.
+LOG_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# How often (in seconds) to check for new log lines to push to job pages
+# following a job's log, and the most to send at once.
+LOG_PUSH_INTERVAL = 1
+LOG_PUSH_MAX = 64 * 1024
+
 # The timeouts for running the initial compilation step and for running
 # the synthesis step (or running an opaque Makefile), the latter of
 # which has to be really long because synthesis is so slow.
@@ -81,19 +224,42 @@ DEFAULT_F1_MODE = 'sw_emu'  # Use the "mode" job config option to override.
 S3_BUCKET = 'test-bucket-1025132741'
 S3_DCP = 'DCPs'  # dcp-folder-name
 S3_LOG = 'SDAccel_log'  # logs-folder-name
-AFI_CHECK_INTERVAL = 300  # Sleep time between each AFI status check.
+AFI_CHECK_MIN_INTERVAL = 30  # Shortest time between AFI status checks.
+AFI_CHECK_INTERVAL = 300  # Longest time between AFI status checks.
+AFI_CHECK_MAX_ERRORS = 10  # Failed checks in a row before an AFI job fails.
+XRT_SETUP = '/opt/xilinx/xrt/setup.sh'  # Sourced (once) to run on the FPGA.
+
+# The FPGA slots on the F1 instance to run jobs on (e.g., `list(range(8))` on
+# an f1.16xlarge). Each slot gets its own execution thread. Emulation runs do
+# not take a slot; PARALLELISM_EXEC_EMU of them can run at once.
+FPGA_SLOTS = [0]
+PARALLELISM_EXEC_EMU = 2
+
+# Skip clearing and loading an FPGA slot when the AFI it already holds is
+# the one the next job needs, and have each slot prefer the waiting jobs
+# that use its AFI---but for at most FPGA_REUSE_LIMIT jobs in a row.
+FPGA_REUSE_AFI = True
+FPGA_REUSE_LIMIT = 16
 
 # Keywords for "interesting" lines in the log. Case and location insensitive.
-# Can use regex for these.
+# Can use regex for these. Lines are matched as they are logged, so changes
+# here only affect lines logged afterward.
 IMPORTANT_WORDS = [
     "warn",
     "error",
     "ignore", "ignoring"
 ]
 
+# The number of interesting lines (see above) to show per page on job pages.
+INTERESTING_PAGE_SIZE = 100
+
 # Configuration variables to look for when running the make stage. Can use
 # regex for these. Case insensitive.
 MAKE_CONF_VARS = [
     "device", "platform", "estimate", "target", "directives", "target_freq"
     # "\S*cxx\S*", "\S*flags\S*"
 ]
+
+# Cache the configuration variables found for each make command and set of
+# makefiles, so that builds with identical makefiles skip make's dry run.
+MAKE_CONF_CACHE = True
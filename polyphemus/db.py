@@ -1,20 +1,30 @@
 import threading
 import secrets
+import socket
 import time
 import os
+import fcntl
 from contextlib import contextmanager
 import json
+import re
 from datetime import datetime
 from collections import defaultdict
-import random
+from bisect import bisect_left, insort
 
 from . import state
+from . import inotify
+from . import logs
+from . import scheduler
 
 JOBS_DIR = 'jobs'
 ARCHIVE_NAME = 'code'
 CODE_DIR = 'code'
 INFO_FILENAME = 'info.json'
 LOG_FILENAME = 'log.txt'
+INTERESTING_FILENAME = 'interesting.jsonl'
+LEASE_FILENAME = 'lease.json'
+LOCK_FILENAME = 'jobs.lock'
+MANIFEST_FILENAME = 'manifest.jsonl'
 
 
 @contextmanager
@@ -27,6 +37,65 @@ def chdir(path):
     os.chdir(old_dir)
 
 
+def _write_json(path, value):
+    """Atomically replace the JSON file at `path`, so that concurrent
+    readers (possibly in other processes) never see a partial file.
+    """
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def summary(job):
+    """Get the summary of a job that is kept in the job manifest: the
+    fields needed to list jobs.
+    """
+    config = job.get('config') or {}
+    return {
+        'name': job['name'],
+        'hwname': config.get('hwname'),
+        'started': job['started'],
+        'state': job['state'],
+        'mode': job.get('mode') or config.get('mode'),
+        'submitter': config.get('submitter') or '',
+    }
+
+
+def encode_cursor(row):
+    """Get the pagination cursor for listing the jobs after (i.e., older
+    than) the given summary row.
+    """
+    return '{!r}:{}'.format(row['started'], row['name'])
+
+
+def decode_cursor(cursor):
+    """Get the `(started, name)` sort key from a pagination cursor.
+    Raise a ValueError if it is malformed.
+    """
+    started, name = cursor.split(':', 1)
+    return float(started), name
+
+
+def matches(row, mode=None, hwname=None):
+    """Check whether a summary row has the given mode and an hwname
+    starting with the given prefix (when these are specified).
+    """
+    if mode and row['mode'] != mode:
+        return False
+    if hwname and not (row['hwname'] or '').startswith(hwname):
+        return False
+    return True
+
+
+def _remove_sorted(keys, key):
+    """Remove a key from a sorted list, if it is there.
+    """
+    i = bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+        del keys[i]
+
+
 class NotFoundError(Exception):
     """The job indicated could not be found.
     """
@@ -41,20 +110,85 @@ class BadJobError(Exception):
 class JobDB:
     """A wrapper around the jobs directory. Worker threads use this to
     acquire potential jobs and move them along the state transition graph.
+
+    Acquiring a job takes out a *lease* on it that expires after
+    `lease_timeout` seconds unless it is renewed (see `renew_leases`). A
+    job whose lease expires, e.g., because the worker holding it
+    crashed, is returned to the state it was acquired from. Leases are
+    stored next to the jobs and claimed under a file lock, so several
+    workprocs can share one instance directory.
+
+    Log lines matching any of the `important_words` patterns are
+    recorded in a per-job index as they are logged. Logs are written
+    through `log_pool` (a `logs.LogPool`).
+
+    When several jobs are waiting in a state, `sched` (a
+    `scheduler.Scheduler`) decides which one is acquired first.
     """
-    def __init__(self, base_path):
+    def __init__(self, base_path, lease_timeout=600, important_words=(),
+                 log_pool=None, sched=None):
         self.base_path = base_path
         os.makedirs(self.base_path, exist_ok=True)
         os.makedirs(os.path.join(self.base_path, JOBS_DIR), exist_ok=True)
 
-        # Cache of jobs that are in DONE or FAIL state.
-        self.finished_cache = set()
-
-        # Lock for the cache.
-        self.cache_lock = threading.Lock()
-
-        # Lock for the DB.
-        self.cv = threading.Condition()
+        # Index of jobs by state. Each state maps job names to their
+        # scheduler entries (see `scheduler.entry`). `indexed` maps each
+        # known job name to the state it is filed under.
+        self.index = defaultdict(dict)
+        self.indexed = {}
+
+        # Jobs whose directories exist but that we could not read yet
+        # (e.g., because they are still being created), and the last
+        # modification time we saw on the jobs directory.
+        self.unindexed = set()
+        self.jobs_mtime = None
+
+        # Lock for the DB, and a condition variable (sharing that lock)
+        # for each state that workers wait on to acquire jobs in that
+        # state.
+        self.lock = threading.RLock()
+        self.cvs = defaultdict(lambda: threading.Condition(self.lock))
+
+        # The number of workers waiting in each state with a `select`
+        # function (see `acquire`).
+        self.selective = defaultdict(int)
+
+        # Identity used for leases taken by this process, the leases it
+        # currently holds (mapping job names to the holding thread's
+        # ident), and how long they last.
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.leases = {}
+        self.lease_timeout = lease_timeout
+
+        # Pattern for "interesting" log lines, if any.
+        self.interest_re = re.compile('|'.join(important_words), re.I) \
+            if important_words else None
+
+        # Buffered writers for job logs.
+        self.log_pool = log_pool or logs.LogPool()
+
+        # The policy for choosing among queued jobs, and the states that
+        # jobs acquired from a shared state (see `Scheduler`) are moved
+        # to, mapped to that shared state.
+        self.sched = sched or scheduler.Scheduler()
+        self.shared_from = {}
+
+        # The file currently locked by `_disk_lock`, if any.
+        self.disk_lock_file = None
+
+        # Our copy of the job manifest (mapping job names to summary
+        # rows), along with how far into the manifest file we have read,
+        # the number of lines read, and the file's inode (which changes
+        # when it is compacted).
+        self.manifest_rows = {}
+        self.manifest_pos = 0
+        self.manifest_lines = 0
+        self.manifest_ino = None
+
+        # Sorted `(started, name)` keys for all jobs in the manifest and
+        # for the jobs in each state, for paging through job lists.
+        self.manifest_order = []
+        self.manifest_by_state = defaultdict(list)
 
     def job_dir(self, job_name):
         """Get the path to a job's work directory.
@@ -69,6 +203,37 @@ class JobDB:
         """Get the path to a job's log file."""
         return os.path.join(self.job_dir(name), LOG_FILENAME)
 
+    def _interesting_path(self, name):
+        """Get the path to a job's index of interesting log lines."""
+        return os.path.join(self.job_dir(name), INTERESTING_FILENAME)
+
+    def _lease_path(self, name):
+        """Get the path to a job's lease file."""
+        return os.path.join(self.job_dir(name), LEASE_FILENAME)
+
+    @contextmanager
+    def _disk_lock(self):
+        """Hold an exclusive lock on the jobs directory, shared with
+        other processes (including ones on other machines, when the
+        instance directory is on shared storage with POSIX lock support).
+
+        POSIX locks are per-process, so this also holds `self.lock`.
+        Nested uses are allowed.
+        """
+        with self.lock:
+            if self.disk_lock_file is not None:
+                yield
+                return
+
+            with open(os.path.join(self.base_path, LOCK_FILENAME), 'a') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                self.disk_lock_file = f
+                try:
+                    yield
+                finally:
+                    self.disk_lock_file = None
+                    fcntl.lockf(f, fcntl.LOCK_UN)
+
     def _read(self, name):
         """Read a job from its info file.
 
@@ -87,34 +252,353 @@ class JobDB:
     def _write(self, job):
         """Write a job back to its info file.
         """
-        with open(self._info_path(job['name']), 'w') as f:
-            json.dump(job, f)
+        _write_json(self._info_path(job['name']), job)
+        self._index(job)
+        self._update_manifest(job)
+
+    def _manifest_path(self):
+        """Get the path to the job manifest file."""
+        return os.path.join(self.base_path, MANIFEST_FILENAME)
+
+    def _load_manifest(self):
+        """Catch up with changes to the manifest file since we last read
+        it. The manifest is a log of JSON summary rows, one per line;
+        the last row for each job wins. If there is no manifest yet,
+        build one.
+        """
+        with self.lock:
+            try:
+                f = open(self._manifest_path(), 'rb')
+            except FileNotFoundError:
+                self.rebuild_manifest()
+                return
+
+            with f:
+                ino = os.fstat(f.fileno()).st_ino
+                fresh = ino != self.manifest_ino
+                if fresh:
+                    # New or compacted file: start from scratch.
+                    self.manifest_rows = {}
+                    self.manifest_pos = 0
+                    self.manifest_lines = 0
+                    self.manifest_ino = ino
+
+                f.seek(self.manifest_pos)
+                data = f.read()
+
+            # Ignore any incomplete line at the end.
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if fresh:
+                    self.manifest_rows[row['name']] = row
+                else:
+                    self._set_manifest_row(row)
+                self.manifest_lines += 1
+            self.manifest_pos += end
+
+            # Sort all the keys at once when loading the whole file.
+            if fresh:
+                self.manifest_order = []
+                self.manifest_by_state = defaultdict(list)
+                for row in self.manifest_rows.values():
+                    key = (row['started'], row['name'])
+                    self.manifest_order.append(key)
+                    self.manifest_by_state[row['state']].append(key)
+                self.manifest_order.sort()
+                for keys in self.manifest_by_state.values():
+                    keys.sort()
+
+    def _set_manifest_row(self, row):
+        """Update our copy of the manifest with a new row for a job,
+        keeping the sorted keys up to date.
+        """
+        old_row = self.manifest_rows.get(row['name'])
+        if old_row:
+            old_key = (old_row['started'], old_row['name'])
+            _remove_sorted(self.manifest_order, old_key)
+            _remove_sorted(self.manifest_by_state[old_row['state']], old_key)
+
+        key = (row['started'], row['name'])
+        self.manifest_rows[row['name']] = row
+        insort(self.manifest_order, key)
+        insort(self.manifest_by_state[row['state']], key)
+
+    def _update_manifest(self, job):
+        """Record a job's current summary in the manifest, if it has
+        changed. Compact the manifest when it gets too long.
+        """
+        row = summary(job)
+        with self._disk_lock():
+            self._load_manifest()
+            if self.manifest_rows.get(row['name']) == row:
+                return
+
+            line = (json.dumps(row) + '\n').encode('utf8')
+            with open(self._manifest_path(), 'ab') as f:
+                f.write(line)
+            self._set_manifest_row(row)
+            self.manifest_pos += len(line)
+            self.manifest_lines += 1
+
+            if self.manifest_lines > 2 * len(self.manifest_rows) + 1000:
+                self._write_manifest(self.manifest_rows.values())
+
+    def _write_manifest(self, rows):
+        """Replace the manifest file with one row per job.
+        """
+        with self._disk_lock():
+            path = self._manifest_path()
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                for row in rows:
+                    f.write((json.dumps(row) + '\n').encode('utf8'))
+            os.replace(tmp_path, path)
+
+            # Read it back in.
+            self.manifest_ino = None
+            self._load_manifest()
+
+    def rebuild_manifest(self):
+        """Rebuild the job manifest from scratch by reading every job.
+        """
+        self._write_manifest(summary(job) for job in self._all())
+
+    def query(self, limit=None, cursor=None, state=None, mode=None,
+              hwname=None, since=None, until=None):
+        """Get a page of summary rows, newest first, and the cursor for
+        the next page (or None if this is the last page).
+
+        Start after the job indicated by `cursor` (see `encode_cursor`).
+        Only include jobs in `state`, with `mode`, with an hwname
+        starting with `hwname`, and started at or after `since` and
+        before `until` (as timestamps), when these are given. Get all
+        the matching jobs if `limit` is None.
+
+        This uses sorted keys for all jobs and for each state, so the
+        cost is proportional to the page size (plus any jobs skipped by
+        the `mode` and `hwname` filters), not to the total number of
+        jobs.
+        """
+        with self.lock:
+            self._load_manifest()
+            keys = self.manifest_by_state[state] if state \
+                else self.manifest_order
+
+            lo = bisect_left(keys, (since,)) if since is not None else 0
+            hi = len(keys)
+            if until is not None:
+                hi = min(hi, bisect_left(keys, (until,)))
+            if cursor:
+                hi = min(hi, bisect_left(keys, decode_cursor(cursor)))
+
+            rows = []
+            for i in range(hi - 1, lo - 1, -1):
+                row = self.manifest_rows[keys[i][1]]
+                if not matches(row, mode, hwname):
+                    continue
+                if limit is not None and len(rows) == limit:
+                    return rows, encode_cursor(rows[-1])
+                rows.append(row)
+            return rows, None
+
+    def _index(self, job):
+        """File a job under its current state in the state index, or
+        update its scheduler entry if it is already filed there.
+        """
+        name, state = job['name'], job['state']
+        with self.lock:
+            old_state = self.indexed.get(name)
+            if old_state is not None and old_state != state:
+                self.index[old_state].pop(name, None)
+            self.index[state][name] = scheduler.entry(job)
+            self.indexed[name] = state
+            self.unindexed.discard(name)
+
+    def _unindex(self, name):
+        """Remove a job from the state index.
+        """
+        with self.lock:
+            old_state = self.indexed.pop(name, None)
+            if old_state is not None:
+                self.index[old_state].pop(name, None)
+
+    def _discover(self):
+        """Add jobs that appeared on disk since we last looked to the
+        index.
+
+        The jobs directory is only listed when its modification time
+        changes, so this is cheap when no jobs have been added. Jobs
+        that cannot be read yet are retried on every call.
+        """
+        jobs_dir = os.path.join(self.base_path, JOBS_DIR)
+        mtime = os.stat(jobs_dir).st_mtime_ns
+        with self.lock:
+            if mtime != self.jobs_mtime:
+                self.jobs_mtime = mtime
+                names = set(os.listdir(jobs_dir)) - self.indexed.keys()
+                self.unindexed |= names
+
+            found = []
+            for name in list(self.unindexed):
+                try:
+                    found.append(self._read(name))
+                except (NotFoundError, BadJobError):
+                    continue
+
+            # File newly discovered jobs oldest-first.
+            for job in sorted(found, key=lambda j: j['started']):
+                self._index(job)
+
+    def refresh(self, name):
+        """Re-read a job from disk and update the index to match, for
+        example after another process changed it. Wake up waiting
+        workers if the job's state changed. Return the job, or None if
+        it cannot be read.
+        """
+        with self.lock:
+            try:
+                job = self._read(name)
+            except NotFoundError:
+                self._unindex(name)
+                return None
+            except BadJobError:
+                return None
+            changed = self.indexed.get(name) != job['state']
+            self._index(job)
+            if changed:
+                self._notify(job['state'])
+            return job
+
+    def reindex(self):
+        """Bring the state index up to date with changes made by other
+        processes. Re-read the jobs indexed in unfinished states, the
+        jobs whose state in the manifest differs from the index (e.g.,
+        finished jobs that were restarted), and any new jobs, then wake
+        up waiting workers.
 
-    def _all(self, with_cache=False):
+        The info files are read without holding the lock, and a job's
+        entry is only replaced if this process did not change it in the
+        meantime.
+        """
+        jobs_dir = os.path.join(self.base_path, JOBS_DIR)
+        with self.lock:
+            self._load_manifest()
+            seen = dict(self.indexed)
+            names = {name for name, st in seen.items()
+                     if st not in state.FINAL_STATES}
+            names |= {name for name, row in self.manifest_rows.items()
+                      if seen.get(name) != row['state']}
+        names |= set(os.listdir(jobs_dir)) - seen.keys()
+
+        jobs = {}
+        for name in names:
+            try:
+                jobs[name] = self._read(name)
+            except NotFoundError:
+                jobs[name] = None
+            except BadJobError:
+                continue
+
+        # File newly discovered jobs oldest-first.
+        def started(name):
+            return jobs[name]['started'] if jobs.get(name) else 0
+
+        with self.lock:
+            for name in sorted(names, key=started):
+                if self.indexed.get(name) != seen.get(name):
+                    continue
+                job = jobs.get(name)
+                if job is not None:
+                    self._index(job)
+                elif name not in seen:
+                    # Not readable yet; `_discover` will retry it.
+                    self.unindexed.add(name)
+                elif name in jobs:
+                    # The job was deleted.
+                    self._unindex(name)
+            self.notify_all()
+
+    def watch(self):
+        """Watch the jobs directory with inotify and refresh jobs as
+        soon as their info files change, so waiting workers hear about
+        new jobs and state changes immediately. Run indefinitely.
+
+        Only changes made on this machine are seen (inotify does not
+        report changes made by other NFS clients, for example), so this
+        complements polling rather than replacing it.
+
+        Finished jobs are not watched, and a job's watch is removed when
+        it finishes, so the number of watches stays proportional to the
+        number of active jobs.
+        """
+        notifier = inotify.Inotify()
+        jobs_dir = os.path.join(self.base_path, JOBS_DIR)
+        jobs_wd = notifier.add_watch(jobs_dir, inotify.IN_CREATE |
+                                     inotify.IN_MOVED_TO | inotify.IN_ONLYDIR)
+        job_wds = {}
+
+        def watch_job(name):
+            try:
+                wd = notifier.add_watch(
+                    os.path.join(jobs_dir, name),
+                    inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+                    inotify.IN_ONLYDIR,
+                )
+            except OSError as exc:
+                # Out of watches (ENOSPC) or the job disappeared. We'll
+                # find out about this job by polling.
+                print('cannot watch job', name, exc)
+                return None
+            job_wds[wd] = name
+            return wd
+
+        def unwatch_finished(wd, job):
+            if job and job['state'] in state.FINAL_STATES:
+                job_wds.pop(wd, None)
+                try:
+                    notifier.rm_watch(wd)
+                except OSError:
+                    # The directory is already gone.
+                    pass
+
+        # Use the manifest to skip jobs that are already finished.
+        with self.lock:
+            self._load_manifest()
+            finished = {name for name, row in self.manifest_rows.items()
+                        if row['state'] in state.FINAL_STATES}
+        for name in os.listdir(jobs_dir):
+            if name not in finished:
+                watch_job(name)
+
+        while True:
+            for wd, mask, name in notifier.read():
+                if mask & inotify.IN_Q_OVERFLOW:
+                    self.reindex()
+                elif wd == jobs_wd:
+                    if mask & inotify.IN_ISDIR:
+                        # A new job directory. Its info file may have been
+                        # written before the watch was in place.
+                        job_wd = watch_job(name)
+                        job = self.refresh(name)
+                        if job_wd is not None:
+                            unwatch_finished(job_wd, job)
+                elif mask & inotify.IN_IGNORED:
+                    job_wds.pop(wd, None)
+                elif name == INFO_FILENAME and wd in job_wds:
+                    unwatch_finished(wd, self.refresh(job_wds[wd]))
+
+    def _all(self):
         """Read all the jobs.
 
         Corrupted/unreadable jobs are not included in the list. This is
         probably pretty slow, and it's O(n) where n is the total number
         of jobs in the system.
-
-        When `with_cache` is True, prioritize returning jobs that are not
-        in a done state in the cache.
         """
-        # Names of job to traverse. Since job names are unique, calling set
-        # is safe.
-        traversal_set = set(os.listdir(os.path.join(self.base_path, JOBS_DIR)))
-
-        # Move the jobs in the done cache to the back and shuffle both lists.
-        # We still have to check jobs in the cache in case state was manually
-        # updated.
-        traversal = list(traversal_set - self.finished_cache)
-        remaining = list(self.finished_cache)
-        random.shuffle(traversal)
-        random.shuffle(remaining)
-
-        traversal += remaining
-
-        for name in traversal:
+        for name in os.listdir(os.path.join(self.base_path, JOBS_DIR)):
             path = self._info_path(name)
             if os.path.isfile(path):
                 with open(path) as f:
@@ -123,39 +607,147 @@ class JobDB:
                     except json.JSONDecodeError:
                         continue
 
-    def _acquire(self, old_state, new_state):
+    def _read_lease(self, name):
+        """Read a job's lease, or return None if it has none.
+        """
+        try:
+            with open(self._lease_path(name)) as f:
+                return json.load(f)
+        except (IOError, json.JSONDecodeError):
+            return None
+
+    def _take_lease(self, name, from_state):
+        """Record that this process holds the named job, which it
+        acquired from `from_state`.
+        """
+        _write_json(self._lease_path(name), {
+            'owner': self.owner,
+            'state': from_state,
+            'expires': time.time() + self.lease_timeout,
+        })
+        self.leases[name] = threading.get_ident()
+
+    def _release(self, name):
+        """Give up this process's lease on a job, if it holds one.
+        """
+        if self.leases.pop(name, None) is not None:
+            try:
+                os.unlink(self._lease_path(name))
+            except FileNotFoundError:
+                pass
+
+    def _reclaim(self, old_state):
+        """Return jobs whose leases have expired to `old_state`, if that
+        is the state they were acquired from.
+
+        Only jobs in locked states can hold leases, so this looks at
+        (usually few) in-progress jobs.
+        """
+        now = time.time()
+        for locked_state in state.LOCKED_STATES:
+            for name in list(self.index[locked_state]):
+                lease = self._read_lease(name)
+                if not lease or lease['state'] != old_state or \
+                        lease['expires'] > now:
+                    continue
+                try:
+                    job = self._read(name)
+                except (NotFoundError, BadJobError):
+                    continue
+                if job['state'] not in state.LOCKED_STATES:
+                    continue
+
+                self.log(name, 'lease held by {} expired; returning to '
+                               'state {}'.format(lease['owner'], old_state))
+                print(name, 'reclaimed from', lease['owner'])
+                job['state'] = old_state
+                self._write(job)
+                os.unlink(self._lease_path(name))
+
+    def _acquire(self, old_state, new_state, select=None, prefer=None):
         """Look for a job in `old_state`, update it to `new_state`, and
-        return it.
-
-        First check the job_cache for matching jobs and test if they are still
-        in that state. If no job is found in that state, call _all.
+        return it. If `select` is given, only take a job if
+        `select(entry, running)` is true for its scheduler entry, where
+        `running` lists the entries for the jobs in `new_state` held by
+        this process. If `prefer` is given, jobs for which
+        `prefer(entry)` is true go first.
+
+        Candidates come from the state index, so this only looks at
+        jobs queued in `old_state`, and they are tried in the order
+        given by the scheduler. The on-disk state of the candidate is
+        checked (under the cross-process lock) before it is taken; stale
+        index entries are fixed along the way.
 
         Raise a `NotFoundError` if there is no such job.
         """
+        self._discover()
+
+        with self._disk_lock():
+            self._reclaim(old_state)
+
+            running = None
+            if old_state in self.sched.share_states:
+                running = list(self.index[new_state].values())
+                self.shared_from[new_state] = old_state
+            queued = self.sched.order(self.index[old_state].items(),
+                                      running=running)
+            if select:
+                mine = [self.index[new_state][n] for n in self.leases
+                        if n in self.index[new_state]]
+                queued = [n for n in queued
+                          if select(self.index[old_state][n], mine)]
+            if prefer:
+                queued.sort(key=lambda n: not prefer(self.index[old_state][n]))
+            for name in queued:
+                try:
+                    job = self._read(name)
+                except NotFoundError:
+                    self._unindex(name)
+                    continue
+                except BadJobError:
+                    continue
 
-        for job in self._all(with_cache=True):
-            if job['state'] == old_state:
-                break
-            elif job['state'] in [state.DONE, state.FAIL]:
-                with self.cache_lock:
-                    self.finished_cache.add(job['name'])
-        else:
-            print('No job in state', old_state)
-            raise NotFoundError()
+                if job['state'] == old_state:
+                    break
+                else:
+                    self._index(job)
+            else:
+                print('No job in state', old_state)
+                raise NotFoundError()
+
+            # Take the lease before updating the state, so the job is
+            # never in a locked state without a lease.
+            self._take_lease(job['name'], old_state)
+            job['state'] = new_state
+            self._write(job)
+            if running is not None:
+                self.sched.took(scheduler.entry(job))
 
-        job['state'] = new_state
         self.log(job['name'], 'acquired in state {}'.format(new_state))
-        print(job['name'],
-              'acquired in state {}. Cache size: {}.'.format(new_state, len(self.finished_cache)))
-        with open(self._info_path(job['name']), 'w') as f:
-            json.dump(job, f)
-
-        if job['state'] not in [state.DONE, state.FAIL]:
-            with self.cache_lock:
-                self.finished_cache.discard(job['name'])
+        print(job['name'], 'acquired in state {}.'.format(new_state))
 
         return job
 
+    def renew_leases(self, thread_ident):
+        """Extend the leases held by the given thread. Worker threads
+        must call this more often than the lease timeout while they are
+        working on a job.
+        """
+        with self.lock:
+            names = [n for n, t in self.leases.items() if t == thread_ident]
+            if not names:
+                return
+            with self._disk_lock():
+                for name in names:
+                    lease = self._read_lease(name)
+                    if not lease or lease['owner'] != self.owner:
+                        # Someone else reclaimed the job.
+                        self.log(name, 'lease lost by {}'.format(self.owner))
+                        del self.leases[name]
+                        continue
+                    lease['expires'] = time.time() + self.lease_timeout
+                    _write_json(self._lease_path(name), lease)
+
     def _init(self, name, state, config):
         """Given the name of a job *whose directory already exists*,
         initialize with a database entry. In other words, create the job
@@ -184,18 +776,49 @@ class JobDB:
     def add(self, state, config={}):
         """Add a new job and return it.
         """
-        with self.cv:
+        with self.lock:
             job = self._add(state, config)
-            self.cv.notify_all()
+            self._notify(state)
         return job
 
     def log(self, name, message):
         """Add a message to the named job's log.
         """
-        fn = self._log_path(name)
         timestamp = datetime.now().isoformat()
-        with open(fn, 'a') as f:
-            print(timestamp, message, file=f)
+        line = '{} {}\n'.format(timestamp, message)
+        self.log_output(name, line.encode('utf8'))
+
+    def log_output(self, name, data):
+        """Add raw output (bytes consisting of whole lines, e.g., from a
+        command) to the named job's log.
+        """
+        if self.interest_re:
+            self.log_pool.write(self._log_path(name), data,
+                                self._interesting_path(name),
+                                self.interest_re)
+        else:
+            self.log_pool.write(self._log_path(name), data)
+
+    def flush_log(self, name):
+        """Write out any buffered lines in the named job's log.
+        """
+        self.log_pool.flush(self._log_path(name))
+
+    def interesting(self, name, start, count):
+        """Get `count` of the interesting lines from the named job's log,
+        starting at number `start`, as a list of `{'offset', 'line'}`
+        dicts. Also return the total number of interesting lines.
+
+        Jobs logged before the index existed get one built on demand.
+        """
+        index_path = self._interesting_path(name)
+        self.flush_log(name)
+        if not os.path.exists(index_path):
+            log_path = self._log_path(name)
+            if not (self.interest_re and os.path.exists(log_path)):
+                return [], 0
+            logs.build_index(log_path, index_path, self.interest_re)
+        return logs.read_index(index_path, start, count)
 
     @contextmanager
     def create(self, state, config={}):
@@ -209,36 +832,151 @@ class JobDB:
         os.mkdir(job_dir)
         with chdir(job_dir):
             yield name
-        with self.cv:
+        with self.lock:
             self._init(name, state, config)
-            self.cv.notify_all()
+            self._notify(state)
 
     def set_state(self, job, state):
         """Update a job's state.
         """
-        with self.cv:
+        with self.lock:
+            old_state = job['state']
             job['state'] = state
             self.log(job['name'], 'state changed to {}'.format(state))
+            self.flush_log(job['name'])
             self._write(job)
-            self.cv.notify_all()
+            self._release(job['name'])
+            self._notify(state)
+
+            # A shared slot opened up, so a waiting job may now be
+            # allowed to take it.
+            if old_state in self.shared_from:
+                self._notify(self.shared_from[old_state])
+
+    def _notify(self, state):
+        """Wake up one worker waiting to acquire a job in `state`. If
+        some of them only take certain jobs, wake them all up, since the
+        first one might not take it.
+        """
+        with self.lock:
+            if self.selective[state]:
+                self.cvs[state].notify_all()
+            else:
+                self.cvs[state].notify()
+
+    def notify_all(self):
+        """Wake up all waiting workers, e.g., to have them look for
+        changes we were not told about.
+        """
+        with self.lock:
+            for cv in self.cvs.values():
+                cv.notify_all()
 
-    def acquire(self, old_state, new_state):
+    def acquire(self, old_state, new_state, select=None, prefer=None):
         """Block until a job is available in `old_state`, update its
-        state to `new_state`, and return it.
+        state to `new_state`, and return it. Only jobs accepted by
+        `select` are taken, and those accepted by `prefer` go first (see
+        `_acquire`).
+
+        Waiting workers are woken up one at a time when a job enters
+        the state they are waiting for.
         """
-        with self.cv:
+        with self.lock:
             while True:
                 try:
-                    job = self._acquire(old_state, new_state)
+                    job = self._acquire(old_state, new_state, select,
+                                        prefer)
                 except NotFoundError:
                     pass
                 else:
                     break
-                self.cv.wait()
+                if select:
+                    self.selective[old_state] += 1
+                try:
+                    self.cvs[old_state].wait()
+                finally:
+                    if select:
+                        self.selective[old_state] -= 1
             return job
 
     def get(self, name):
         """Get the job with the given name.
         """
-        with self.cv:
+        with self.lock:
             return self._read(name)
+
+    def jobs(self, state):
+        """Get the jobs in a state.
+        """
+        self._discover()
+        with self.lock:
+            names = list(self.index[state])
+            jobs = []
+            for name in names:
+                try:
+                    job = self._read(name)
+                except NotFoundError:
+                    self._unindex(name)
+                    continue
+                except BadJobError:
+                    continue
+                if job['state'] == state:
+                    jobs.append(job)
+                else:
+                    self._index(job)
+            return jobs
+
+    def transition(self, name, old_state, new_state):
+        """Move a job from `old_state` to `new_state`, if it is still in
+        `old_state`, without acquiring it. Return the job, or None if
+        it was not in `old_state`.
+        """
+        with self._disk_lock():
+            try:
+                job = self._read(name)
+            except (NotFoundError, BadJobError):
+                return None
+            if job['state'] != old_state:
+                self._index(job)
+                return None
+            self.set_state(job, new_state)
+            return job
+
+    def set_config(self, name, key, value):
+        """Change one of a job's configuration options, keeping any
+        other changes made to the job meanwhile (e.g., by a worker).
+        Return the updated job.
+        """
+        with self._disk_lock():
+            job = self._read(name)
+            job['config'][key] = value
+            self._write(job)
+            return job
+
+    def wait(self, state, timeout=None):
+        """Block until a job enters `state` (or `timeout` seconds pass).
+        """
+        with self.lock:
+            self.cvs[state].wait(timeout)
+
+
+def open_db(base_path, config):
+    """Open the job database for an instance directory using the
+    backend selected by the `DB_BACKEND` configuration option.
+    """
+    log_pool = logs.LogPool(config['LOG_POOL_SIZE'],
+                            config['LOG_FLUSH_INTERVAL'],
+                            segment_size=config['LOG_SEGMENT_SIZE'])
+    sched = scheduler.Scheduler(config['SCHED_MODE_BONUS'],
+                                config['SCHED_AGING'],
+                                (state.MAKE,),
+                                config['MAKE_SHARE_CAP'],
+                                config['MAKE_SHARE_WEIGHTS'])
+    if config['DB_BACKEND'] == 'sqlite':
+        # Imported here because the SQLite backend builds on this module.
+        from .db_sqlite import SqliteJobDB
+        cls = SqliteJobDB
+    else:
+        cls = JobDB
+    return cls(base_path, config['LEASE_TIMEOUT'], config['IMPORTANT_WORDS'],
+               log_pool, sched)
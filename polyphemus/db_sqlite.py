@@ -0,0 +1,456 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from . import state
+from . import inotify
+from . import scheduler
+from .db import JobDB, NotFoundError, BadJobError, JOBS_DIR, INFO_FILENAME, \
+    summary, encode_cursor, decode_cursor
+
+DB_FILENAME = 'jobs.sqlite'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS jobs (
+        name TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        started REAL NOT NULL,
+        hwname TEXT,
+        info TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, started)',
+    'CREATE INDEX IF NOT EXISTS jobs_started ON jobs (started)',
+    'CREATE INDEX IF NOT EXISTS jobs_hwname ON jobs (hwname)',
+]
+
+# Columns added to the jobs table after its initial version. They are
+# added to existing databases when they are opened.
+COLUMNS = [
+    ('lease_owner', 'TEXT'),
+    ('lease_state', 'TEXT'),
+    ('lease_expires', 'REAL'),
+    ('mode', 'TEXT'),
+    ('submitter', 'TEXT'),
+]
+
+# Indices on the columns above, created after the columns are added.
+COLUMN_INDICES = [
+    'CREATE INDEX IF NOT EXISTS jobs_mode ON jobs (mode, started)',
+]
+
+# The summary columns that make up the job manifest.
+MANIFEST_COLUMNS = ['name', 'hwname', 'started', 'state', 'mode',
+                    'submitter']
+
+
+class SqliteJobDB(JobDB):
+    """A job database that keeps job metadata in a SQLite database (in
+    WAL mode) in the instance directory instead of in per-job info
+    files. Job files and logs still live in the jobs directory.
+
+    Acquiring a job is a single transaction, so it is safe for several
+    processes (e.g., the server and a separate workproc) to share the
+    database. Leases are kept in the jobs table.
+    """
+    def __init__(self, base_path, lease_timeout=600, important_words=(),
+                 log_pool=None, sched=None):
+        super(SqliteJobDB, self).__init__(base_path, lease_timeout,
+                                          important_words, log_pool, sched)
+        self.db_path = os.path.join(self.base_path, DB_FILENAME)
+
+        # SQLite connections cannot be shared between threads, so each
+        # thread gets its own.
+        self.local = threading.local()
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        for stmt in SCHEMA:
+            conn.execute(stmt)
+        existing = {r[1] for r in conn.execute('PRAGMA table_info(jobs)')}
+        added = [c for c in COLUMNS if c[0] not in existing]
+        for column, typ in added:
+            conn.execute('ALTER TABLE jobs ADD COLUMN {} {}'.format(
+                column, typ
+            ))
+        for stmt in COLUMN_INDICES:
+            conn.execute(stmt)
+        if added:
+            self.rebuild_manifest()
+
+    def _conn(self):
+        """Get the current thread's database connection.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Use autocommit mode; transactions are started explicitly.
+            conn = sqlite3.connect(self.db_path, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def _read(self, name):
+        """Read a job from the database.
+
+        Raise a NotFoundError if there is no such job.
+        """
+        row = self._conn().execute(
+            'SELECT info FROM jobs WHERE name = ?', (name,)
+        ).fetchone()
+        if row is None:
+            raise NotFoundError()
+        try:
+            return json.loads(row[0])
+        except json.JSONDecodeError:
+            raise BadJobError()
+
+    def _write(self, job):
+        """Write a job back to the database.
+        """
+        row = summary(job)
+        self._conn().execute(
+            'INSERT INTO jobs '
+            '(name, state, started, hwname, mode, submitter, info) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET state = excluded.state, '
+            'started = excluded.started, hwname = excluded.hwname, '
+            'mode = excluded.mode, submitter = excluded.submitter, '
+            'info = excluded.info',
+            (job['name'], job['state'], job['started'], row['hwname'],
+             row['mode'], row['submitter'], json.dumps(job)),
+        )
+
+    def _all(self):
+        """Read all the jobs.
+        """
+        rows = self._conn().execute('SELECT info FROM jobs')
+        for (info,) in rows:
+            try:
+                yield json.loads(info)
+            except json.JSONDecodeError:
+                continue
+
+    def query(self, limit=None, cursor=None, state=None, mode=None,
+              hwname=None, since=None, until=None):
+        """Get a page of summary rows, newest first, and the cursor for
+        the next page (or None if this is the last page). The filters
+        are the same as for `JobDB.query`, and are answered using the
+        table's indices.
+        """
+        where = []
+        params = []
+        if state:
+            where.append('state = ?')
+            params.append(state)
+        if mode:
+            where.append('mode = ?')
+            params.append(mode)
+        if hwname:
+            # A prefix match that can use the hwname index.
+            where.append('hwname >= ? AND hwname < ?')
+            params += [hwname, hwname + '\U0010ffff']
+        if since is not None:
+            where.append('started >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('started < ?')
+            params.append(until)
+        if cursor:
+            started, name = decode_cursor(cursor)
+            where.append('(started < ? OR (started = ? AND name < ?))')
+            params += [started, started, name]
+
+        sql = 'SELECT {} FROM jobs'.format(', '.join(MANIFEST_COLUMNS))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY started DESC, name DESC'
+        if limit is not None:
+            # Get one extra row to find out whether there is another page.
+            sql += ' LIMIT ?'
+            params.append(limit + 1)
+
+        rows = [dict(zip(MANIFEST_COLUMNS, r))
+                for r in self._conn().execute(sql, params)]
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            return rows, encode_cursor(rows[-1])
+        return rows, None
+
+    def rebuild_manifest(self):
+        """Recompute the summary columns from the stored jobs.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for job in list(self._all()):
+                row = summary(job)
+                conn.execute(
+                    'UPDATE jobs SET hwname = ?, mode = ?, submitter = ? '
+                    'WHERE name = ?',
+                    (row['hwname'], row['mode'], row['submitter'],
+                     job['name']),
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _reclaim(self, conn, old_state):
+        """Return jobs whose leases have expired to `old_state`, if that
+        is the state they were acquired from. Must be called inside a
+        transaction.
+        """
+        rows = conn.execute(
+            'SELECT info, lease_owner FROM jobs '
+            'WHERE lease_state = ? AND lease_expires < ? '
+            'AND state IN ({})'.format(
+                ', '.join('?' for _ in state.LOCKED_STATES)
+            ),
+            (old_state, time.time()) + state.LOCKED_STATES,
+        ).fetchall()
+        for info, owner in rows:
+            job = json.loads(info)
+            job['state'] = old_state
+            conn.execute(
+                'UPDATE jobs SET state = ?, info = ?, lease_owner = NULL, '
+                'lease_state = NULL, lease_expires = NULL WHERE name = ?',
+                (old_state, json.dumps(job), job['name']),
+            )
+            self.log(job['name'], 'lease held by {} expired; returning to '
+                                  'state {}'.format(owner, old_state))
+            print(job['name'], 'reclaimed from', owner)
+
+    def _acquire(self, old_state, new_state, select=None, prefer=None):
+        """Look for a job in `old_state`, update it to `new_state`, and
+        return it. Jobs in `old_state` are taken in the order given by
+        the scheduler (with those accepted by `prefer` first), and only
+        if `select` accepts them (see `JobDB._acquire`).
+
+        The update is conditional on the job still being in `old_state`
+        and happens in an immediate (write-locked) transaction, so no
+        two processes can acquire the same job.
+
+        Raise a `NotFoundError` if there is no such job.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._reclaim(conn, old_state)
+
+            queued = self._jobs_in(conn, old_state)
+            entries = {n: scheduler.entry(j) for n, j in queued.items()}
+            in_new_state = self._jobs_in(conn, new_state)
+            running = None
+            if old_state in self.sched.share_states:
+                running = [scheduler.entry(j) for j in in_new_state.values()]
+                self.shared_from[new_state] = old_state
+            order = self.sched.order(entries.items(), running=running)
+            if select:
+                mine = [scheduler.entry(j) for n, j in in_new_state.items()
+                        if n in self.leases]
+                order = [n for n in order if select(entries[n], mine)]
+            if prefer:
+                order.sort(key=lambda n: not prefer(entries[n]))
+            if not order:
+                conn.execute('COMMIT')
+                print('No job in state', old_state)
+                raise NotFoundError()
+
+            job = queued[order[0]]
+            job['state'] = new_state
+            cur = conn.execute(
+                'UPDATE jobs SET state = ?, info = ?, lease_owner = ?, '
+                'lease_state = ?, lease_expires = ? '
+                'WHERE name = ? AND state = ?',
+                (new_state, json.dumps(job), self.owner, old_state,
+                 time.time() + self.lease_timeout, job['name'], old_state),
+            )
+            assert cur.rowcount == 1
+            conn.execute('COMMIT')
+            if running is not None:
+                self.sched.took(scheduler.entry(job))
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+        self.leases[job['name']] = threading.get_ident()
+        self.log(job['name'], 'acquired in state {}'.format(new_state))
+        print(job['name'], 'acquired in state {}.'.format(new_state))
+        return job
+
+    def _jobs_in(self, conn, state):
+        """Read the jobs in a state, as a dict mapping names to jobs.
+        """
+        jobs = {}
+        for (info,) in conn.execute(
+            'SELECT info FROM jobs WHERE state = ?', (state,)
+        ):
+            try:
+                job = json.loads(info)
+            except json.JSONDecodeError:
+                continue
+            jobs[job['name']] = job
+        return jobs
+
+    def jobs(self, state):
+        """Get the jobs in a state.
+        """
+        return list(self._jobs_in(self._conn(), state).values())
+
+    def transition(self, name, old_state, new_state):
+        """Move a job from `old_state` to `new_state`, if it is still in
+        `old_state`, without acquiring it (see `JobDB.transition`).
+
+        Like `acquire`, this takes `self.lock` before starting the
+        transaction, so the two cannot deadlock.
+        """
+        conn = self._conn()
+        with self.lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                try:
+                    job = self._read(name)
+                except (NotFoundError, BadJobError):
+                    job = None
+                if job and job['state'] == old_state:
+                    self.set_state(job, new_state)
+                else:
+                    job = None
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+        return job
+
+    def set_config(self, name, key, value):
+        """Change one of a job's configuration options in a single
+        transaction (see `JobDB.set_config`). As in `transition`,
+        `self.lock` is taken first.
+        """
+        conn = self._conn()
+        with self.lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                job = self._read(name)
+                job['config'][key] = value
+                self._write(job)
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+        return job
+
+    def _release(self, name):
+        """Give up this process's lease on a job, if it holds one.
+        """
+        if self.leases.pop(name, None) is not None:
+            self._conn().execute(
+                'UPDATE jobs SET lease_owner = NULL, lease_state = NULL, '
+                'lease_expires = NULL WHERE name = ? AND lease_owner = ?',
+                (name, self.owner),
+            )
+
+    def renew_leases(self, thread_ident):
+        """Extend the leases held by the given thread.
+        """
+        with self.lock:
+            names = [n for n, t in self.leases.items() if t == thread_ident]
+            for name in names:
+                cur = self._conn().execute(
+                    'UPDATE jobs SET lease_expires = ? '
+                    'WHERE name = ? AND lease_owner = ?',
+                    (time.time() + self.lease_timeout, name, self.owner),
+                )
+                if cur.rowcount == 0:
+                    # Someone else reclaimed the job.
+                    self.log(name, 'lease lost by {}'.format(self.owner))
+                    del self.leases[name]
+
+    def refresh(self, name):
+        """The database is always up to date, so there is nothing to
+        re-read. Just wake up a worker waiting for the job's state, and
+        return the job (or None if it cannot be read).
+        """
+        try:
+            job = self._read(name)
+        except (NotFoundError, BadJobError):
+            return None
+        self._notify(job['state'])
+        return job
+
+    def reindex(self):
+        """The database's own indices are always up to date, so there is
+        nothing to rebuild. Just wake up waiting workers.
+        """
+        self.notify_all()
+
+    def watch(self):
+        """Watch the database's write-ahead log with inotify and wake up
+        waiting workers whenever any process commits a change. Run
+        indefinitely.
+        """
+        notifier = inotify.Inotify()
+        notifier.add_watch(self.base_path, inotify.IN_MODIFY)
+        wal_name = DB_FILENAME + '-wal'
+        while True:
+            if any(name == wal_name for _, _, name in notifier.read()):
+                self.reindex()
+
+    def import_jobs(self):
+        """Import jobs from the `info.json` files in the jobs directory
+        (i.e., from a database previously managed by a plain `JobDB`).
+        Jobs that are already in the database are left alone. Return
+        the number of imported jobs.
+        """
+        jobs_dir = os.path.join(self.base_path, JOBS_DIR)
+        conn = self._conn()
+        count = 0
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for name in os.listdir(jobs_dir):
+                path = os.path.join(jobs_dir, name, INFO_FILENAME)
+                if not os.path.isfile(path):
+                    continue
+                with open(path) as f:
+                    try:
+                        job = json.load(f)
+                    except json.JSONDecodeError:
+                        print('skipping malformed job', name)
+                        continue
+
+                row = summary(job)
+                cur = conn.execute(
+                    'INSERT OR IGNORE INTO jobs '
+                    '(name, state, started, hwname, mode, submitter, info) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (job['name'], job['state'], job['started'],
+                     row['hwname'], row['mode'], row['submitter'],
+                     json.dumps(job)),
+                )
+                count += cur.rowcount
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Import existing Polyphemus jobs into a SQLite database.'
+    )
+    parser.add_argument('instance', nargs='?',
+                        default=os.environ.get('POLYPHEMUS_DIR') or 'instance',
+                        help='The instance directory. Defaults to $POLYPHEMUS_DIR or "instance".')
+    opts = parser.parse_args()
+
+    db = SqliteJobDB(opts.instance)
+    print('Imported {} jobs.'.format(db.import_jobs()))
@@ -0,0 +1,91 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+# Event masks from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Layout of `struct inotify_event` (without the trailing name).
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _libc():
+    """Load the C library, or return None if it (or its inotify
+    functions) are not available.
+    """
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+def available():
+    """Check whether inotify can be used on this system.
+    """
+    return _libc() is not None
+
+
+class Inotify:
+    """A minimal wrapper around a Linux inotify file descriptor.
+    """
+    def __init__(self):
+        self.libc = _libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        """Watch a path for the events in `mask`. Return the watch
+        descriptor.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """Stop watching the path for a watch descriptor.
+        """
+        if self.libc.inotify_rm_watch(self.fd, wd) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def read(self, timeout=None):
+        """Wait for events and return them as a list of `(wd, mask,
+        name)` tuples. Return an empty list if `timeout` (in seconds)
+        passes first.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,436 @@
+import atexit
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+# The size of the blocks to read when seeking backward through a log.
+BLOCK_SIZE = 64 * 1024
+
+
+# Long logs are split into segments. The current segment is the log file
+# itself (e.g., `log.txt`); finished segments are renamed (to `log.txt.1`,
+# `log.txt.2`, ...) and then gzipped in the background. A segment list
+# (`log.txt.segments.json`) records each finished segment's file name and
+# its position in the log as a whole. Offsets into a log are always
+# positions in the whole log, across segments.
+
+def _segments_path(path):
+    """Get the path to the segment list for the log at `path`."""
+    return path + '.segments.json'
+
+
+def segments(path):
+    """Get the list of finished segments of a log, as dicts with `file`
+    (the segment's file name), `start` (its offset in the whole log),
+    and `size` (its uncompressed size).
+    """
+    try:
+        with open(_segments_path(path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+
+def _write_segments(path, segs):
+    """Atomically replace the segment list for a log.
+    """
+    seg_path = _segments_path(path)
+    tmp_path = '{}.{}.tmp'.format(seg_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(segs, f)
+    os.replace(tmp_path, seg_path)
+
+
+def _base(segs):
+    """Get the offset where the current segment starts.
+    """
+    return segs[-1]['start'] + segs[-1]['size'] if segs else 0
+
+
+def _parts(path):
+    """Get the parts of a log in order, as `(filename, start, size)`
+    tuples: the finished segments and then the current segment. Raise a
+    FileNotFoundError if there is no such log.
+    """
+    dirname = os.path.dirname(path)
+    segs = segments(path)
+    parts = [(os.path.join(dirname, seg['file']), seg['start'], seg['size'])
+             for seg in segs]
+    try:
+        current_size = os.path.getsize(path)
+    except FileNotFoundError:
+        # Between rotating the log and writing the next line.
+        if not segs:
+            raise
+        current_size = 0
+    parts.append((path, _base(segs), current_size))
+    return parts
+
+
+def _open_part(filename):
+    """Open a log segment for reading, whether or not it has been
+    compressed yet.
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    try:
+        return open(filename, 'rb')
+    except FileNotFoundError:
+        # It was compressed after we read the segment list.
+        return gzip.open(filename + '.gz', 'rb')
+
+
+def size(path):
+    """Get the total size of a log, across all its segments.
+    """
+    _, start, part_size = _parts(path)[-1]
+    return start + part_size
+
+
+def read_range(path, start, end):
+    """Generate the bytes of a log from offset `start` up to `end`, in
+    chunks, reading across segments.
+    """
+    for filename, part_start, part_size in _parts(path):
+        lo = max(start, part_start)
+        hi = min(end, part_start + part_size)
+        if lo >= hi:
+            continue
+        with _open_part(filename) as f:
+            f.seek(lo - part_start)
+            remaining = hi - lo
+            while remaining > 0:
+                chunk = f.read(min(BLOCK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+def _lines(path):
+    """Generate the lines of a log, across segments.
+    """
+    partial = b''
+    for chunk in read_range(path, 0, size(path)):
+        lines = (partial + chunk).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if partial:
+        yield partial
+
+
+def tail(path, lines):
+    """Get the last `lines` lines of a (possibly huge) log as a string.
+    The current segment is read backward from the end in blocks, instead
+    of reading the whole file; earlier segments are only read if it is
+    too short.
+    """
+    data = b''
+    for filename, _, part_size in reversed(_parts(path)):
+        # Read until we have more newlines than requested lines (one
+        # extra for the partial line at the start of the data).
+        if data.count(b'\n') > lines:
+            break
+        if not part_size:
+            continue
+
+        if filename == path:
+            with open(path, 'rb') as f:
+                pos = f.seek(0, os.SEEK_END)
+                while pos > 0 and data.count(b'\n') <= lines:
+                    block = min(BLOCK_SIZE, pos)
+                    pos -= block
+                    f.seek(pos)
+                    data = f.read(block) + data
+        else:
+            with _open_part(filename) as f:
+                data = f.read() + data
+
+    # A trailing newline does not start another line.
+    tail_lines = data.splitlines(keepends=True)[-lines:] if lines else []
+    return b''.join(tail_lines).decode('utf8', errors='replace')
+
+
+def read_from(path, offset, max_bytes):
+    """Read the complete lines appended to a log since byte `offset`.
+    Return the text, the offset where it starts, and the offset just
+    past it.
+
+    If there are more than `max_bytes` bytes to read, skip ahead to (the
+    next line after) the last `max_bytes` of the log. If the log is
+    shorter than `offset` (e.g., it was replaced), start over at the
+    beginning.
+    """
+    log_size = size(path)
+    if offset > log_size:
+        offset = 0
+
+    skip = log_size - offset > max_bytes
+    if skip:
+        offset = log_size - max_bytes
+    data = b''.join(read_range(path, offset, log_size))
+
+    # Skip the partial line at the start when jumping ahead.
+    if skip:
+        start = data.find(b'\n') + 1
+        data = data[start:]
+        offset += start
+
+    # Only send whole lines, so multi-byte characters are never split.
+    end = data.rfind(b'\n') + 1
+    return data[:end].decode('utf8', errors='replace'), offset, offset + end
+
+
+def _record(index_file, regex, data, offset):
+    """Write an index entry for each line in `data` (which starts at
+    byte `offset` of the log) that matches `regex`.
+    """
+    for line in data.splitlines(keepends=True):
+        text = line.decode('utf8', errors='replace')
+        if regex.search(text):
+            entry = {'offset': offset, 'line': text.rstrip('\n')}
+            index_file.write((json.dumps(entry) + '\n').encode('utf8'))
+        offset += len(line)
+
+
+def build_index(path, index_path, regex):
+    """Create the interesting-lines index for an existing log in one
+    pass.
+    """
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    with open(tmp_path, 'wb') as index_file:
+        offset = 0
+        for line in _lines(path):
+            _record(index_file, regex, line, offset)
+            offset += len(line)
+    os.replace(tmp_path, index_path)
+
+
+def read_index(index_path, start, count):
+    """Read `count` entries from an interesting-lines index, starting at
+    entry number `start`. Return the entries and the total number of
+    entries in the index.
+    """
+    entries = []
+    total = 0
+    with open(index_path, 'rb') as f:
+        for line in f:
+            if start <= total < start + count:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+            total += 1
+    return entries, total
+
+
+class LineBuffer:
+    """Collects output (e.g., from a subprocess) that arrives in
+    arbitrary chunks and passes it on in whole lines, so lines are
+    never split when they are indexed.
+    """
+    def __init__(self, write):
+        self.write_lines = write
+        self.partial = b''
+
+    def write(self, data):
+        data = self.partial + data
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        if end:
+            self.write_lines(data[:end])
+
+    def close(self):
+        """Pass on any final incomplete line.
+        """
+        if self.partial:
+            self.write_lines(self.partial + b'\n')
+            self.partial = b''
+
+
+class LogPool:
+    """Buffered writers for job logs (and their interesting-line
+    indices), sharing a bounded pool of open append handles.
+
+    Writes are buffered per log and written out when the buffer fills
+    up, every `flush_interval` seconds (from a background thread), or
+    when `flush` is called. At most `max_open` files are kept open; the
+    least recently used ones are closed first. All methods are
+    thread-safe.
+
+    When a log's current segment grows past `segment_size` bytes, it is
+    rotated and compressed in the background (see `segments`). A
+    `segment_size` of 0 disables rotation.
+    """
+    def __init__(self, max_open=64, flush_interval=1.0,
+                 buffer_size=64 * 1024, segment_size=0):
+        self.max_open = max_open
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.segment_size = segment_size
+        self.lock = threading.RLock()
+
+        # Open files, in least-recently-used order, and the offset where
+        # the current segment starts for each open log.
+        self.files = OrderedDict()
+        self.bases = {}
+
+        # Finished segments waiting to be compressed.
+        self.to_compress = queue.Queue()
+        self.compressor = None
+
+        # Buffered data for each log, with the path and pattern for its
+        # interesting-lines index (if any).
+        self.pending = {}
+
+        self.flusher = None
+        atexit.register(self.flush)
+
+    def _open(self, path):
+        """Get an open append handle for a file from the pool.
+        """
+        f = self.files.pop(path, None)
+        if f is None:
+            f = open(path, 'ab')
+            while len(self.files) >= self.max_open:
+                old_path, old = self.files.popitem(last=False)
+                self.bases.pop(old_path, None)
+                old.close()
+        self.files[path] = f
+        return f
+
+    def _close(self, path):
+        """Close a file's handle, if it is open in the pool.
+        """
+        f = self.files.pop(path, None)
+        if f is not None:
+            f.close()
+        self.bases.pop(path, None)
+
+    def _open_log(self, path):
+        """Get an open append handle for the current segment of a log.
+        """
+        f = self.files.get(path)
+        if f is not None:
+            try:
+                current = os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if not current:
+                # Another process rotated the log.
+                self._close(path)
+
+        f = self._open(path)
+        if path not in self.bases:
+            self.bases[path] = _base(segments(path))
+        return f
+
+    def write(self, path, data, index_path=None, regex=None):
+        """Append `data` (bytes, consisting of whole lines) to the log at
+        `path`. If `index_path` is given, lines matching `regex` are
+        recorded in that interesting-lines index (see `read_index`).
+        """
+        with self.lock:
+            if path in self.pending:
+                self.pending[path][0].extend(data)
+            else:
+                self.pending[path] = (bytearray(data), index_path, regex)
+            if len(self.pending[path][0]) >= self.buffer_size:
+                self._flush(path)
+
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_loop,
+                                                daemon=True)
+                self.flusher.start()
+
+    def _flush(self, path):
+        """Write out the buffered data for a log.
+        """
+        data, index_path, regex = self.pending.pop(path)
+        f = self._open_log(path)
+        f.write(data)
+        f.flush()
+
+        # Find where our data landed, even if another process appended
+        # to the log in the meantime.
+        end = f.tell()
+        offset = self.bases[path] + end - len(data)
+
+        # The index is created along with the log (even if nothing
+        # matches), so a log without an index predates the index.
+        if index_path:
+            index_file = self._open(index_path)
+            _record(index_file, regex, data, offset)
+            index_file.flush()
+
+        if self.segment_size and end >= self.segment_size:
+            self._rotate(path)
+
+    def _rotate(self, path):
+        """Finish the current segment of a log and queue it for
+        compression. The next write starts a new segment.
+        """
+        # Opening the index may already have evicted the log's handle.
+        self._close(path)
+
+        segs = segments(path)
+        seg_name = '{}.{}'.format(os.path.basename(path), len(segs) + 1)
+        seg_path = os.path.join(os.path.dirname(path), seg_name)
+        try:
+            os.rename(path, seg_path)
+        except FileNotFoundError:
+            # Another process rotated it first.
+            return
+        segs.append({
+            'file': seg_name,
+            'start': _base(segs),
+            'size': os.path.getsize(seg_path),
+        })
+        _write_segments(path, segs)
+
+        self.to_compress.put((path, seg_name))
+        if self.compressor is None:
+            self.compressor = threading.Thread(target=self._compress_loop,
+                                               daemon=True)
+            self.compressor.start()
+
+    def _compress_loop(self):
+        """Compress finished log segments with gzip.
+        """
+        while True:
+            path, seg_name = self.to_compress.get()
+            seg_path = os.path.join(os.path.dirname(path), seg_name)
+            gz_path = seg_path + '.gz'
+            with open(seg_path, 'rb') as src, \
+                    gzip.open(gz_path + '.tmp', 'wb') as dest:
+                shutil.copyfileobj(src, dest)
+            os.replace(gz_path + '.tmp', gz_path)
+
+            with self.lock:
+                segs = segments(path)
+                for seg in segs:
+                    if seg['file'] == seg_name:
+                        seg['file'] = seg_name + '.gz'
+                _write_segments(path, segs)
+            os.unlink(seg_path)
+
+    def flush(self, path=None):
+        """Write out the buffered data for the log at `path`, or for all
+        logs.
+        """
+        with self.lock:
+            paths = [path] if path else list(self.pending)
+            for p in paths:
+                if p in self.pending:
+                    self._flush(p)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
@@ -0,0 +1,422 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .db import _write_json
+
+GIB = 1024 ** 3
+
+# The file (in the instance directory) where measured build footprints
+# are kept.
+FOOTPRINTS_FILENAME = 'footprints.json'
+
+
+def meminfo():
+    """Read the host's memory statistics from `/proc/meminfo`, as a dict
+    of byte counts.
+    """
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            parts = value.split()
+            amount = int(parts[0])
+            if parts[1:] == ['kB']:
+                amount *= 1024
+            info[key] = amount
+    return info
+
+
+def cpu_count():
+    """Get the number of cores this process may run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _children(pid):
+    """Get the IDs of a process's child processes.
+    """
+    children = []
+    try:
+        for tid in os.listdir('/proc/{}/task'.format(pid)):
+            with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+                children += [int(c) for c in f.read().split()]
+    except OSError:
+        pass
+    return children
+
+
+def _tree(pid):
+    """Generate the IDs of a process and all of its descendants.
+    """
+    seen = set()
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        if pid not in seen:
+            seen.add(pid)
+            yield pid
+            pids += _children(pid)
+
+
+def tree_rss(pid):
+    """Get the total resident memory, in bytes, of a process and all of
+    its descendants.
+    """
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    for pid in _tree(pid):
+        try:
+            with open('/proc/{}/statm'.format(pid)) as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
+
+def set_tree_affinity(pid, cpus):
+    """Confine a process and all of its descendants to a set of cores.
+    """
+    for pid in _tree(pid):
+        try:
+            os.sched_setaffinity(pid, cpus)
+        except OSError:
+            # It already exited.
+            continue
+
+
+def split_cores(cores, weights):
+    """Divide a list of cores into disjoint sets, one for each weight,
+    with sizes proportional to the weights. Every set gets at least one
+    core; if there are more weights than cores, the sets have to share.
+    """
+    if not weights:
+        return []
+    if len(weights) >= len(cores):
+        return [{cores[i % len(cores)]} for i in range(len(weights))]
+
+    shares = [w * len(cores) / sum(weights) for w in weights]
+    sizes = [max(1, int(s)) for s in shares]
+    while sum(sizes) > len(cores):
+        sizes[sizes.index(max(sizes))] -= 1
+    while sum(sizes) < len(cores):
+        gaps = [s - n for s, n in zip(shares, sizes)]
+        sizes[gaps.index(max(gaps))] += 1
+
+    sets = []
+    pos = 0
+    for size in sizes:
+        sets.append(set(cores[pos:pos + size]))
+        pos += size
+    return sets
+
+
+def _write_cgroup(cgroup, filename, value):
+    """Write a cgroup control file. Return False if that is not possible
+    (e.g., because the controller is not enabled).
+    """
+    try:
+        with open(os.path.join(cgroup, filename), 'w') as f:
+            f.write(value)
+    except OSError:
+        return False
+    return True
+
+
+class PeakMonitor:
+    """Measures the peak memory use of a command's whole process tree by
+    sampling it every `interval` seconds. Pass `start` as the `on_start`
+    callback to `JobTask.run`.
+    """
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.peak = 0
+
+    def start(self, proc):
+        threading.Thread(target=self._sample, args=(proc,),
+                         daemon=True).start()
+
+    def _sample(self, proc):
+        while proc.poll() is None:
+            self.peak = max(self.peak, tree_rss(proc.pid))
+            time.sleep(self.interval)
+
+
+class Admission:
+    """Decides how many builds can run at once on this host, based on
+    its cores and memory and on the estimated footprint of each build.
+
+    `footprints` maps modes to the estimated `(memory in GiB, cores)`
+    used by a build in that mode; modes not listed use `default`. The
+    memory estimates are refined from the peaks measured on this host
+    (kept in `path`). `headroom` GiB are always left free.
+    """
+    def __init__(self, footprints, default, headroom=0, default_mode=None,
+                 path=None):
+        self.footprints = footprints
+        self.default = default
+        self.headroom = headroom * GIB
+        self.default_mode = default_mode
+        self.path = path
+        self.lock = threading.Lock()
+
+        # Measured memory footprints, in bytes, by mode.
+        self.measured = {}
+        if path:
+            try:
+                with open(path) as f:
+                    self.measured = json.load(f)
+            except (IOError, json.JSONDecodeError):
+                pass
+
+    def footprint(self, mode):
+        """Get the estimated memory (in bytes) and cores used by a build
+        in `mode`.
+        """
+        mode = mode or self.default_mode
+        memory, cores = self.footprints.get(mode, self.default)
+        return self.measured.get(mode, memory * GIB), cores
+
+    def fits(self, entry, running):
+        """Check whether the job with the scheduler `entry` can start
+        building alongside the `running` ones. A build can always start
+        when nothing else is running, so huge builds still make
+        progress.
+        """
+        if not running:
+            return True
+        memory, cores = self.footprint(entry['mode'])
+        for other in running:
+            other_memory, other_cores = self.footprint(other['mode'])
+            memory += other_memory
+            cores += other_cores
+
+        # Leave room for the running builds to reach their estimated
+        # footprints, and also for whatever else is using memory now.
+        info = meminfo()
+        available = info.get('MemAvailable', info['MemFree'])
+        new_memory, _ = self.footprint(entry['mode'])
+        return cores <= cpu_count() and \
+            memory + self.headroom <= info['MemTotal'] and \
+            new_memory + self.headroom <= available
+
+    def record(self, mode, peak):
+        """Refine the memory estimate for `mode` with a measured peak.
+        Estimates grow to cover any peak right away but shrink slowly.
+        """
+        if not peak:
+            return
+        mode = mode or self.default_mode
+        with self.lock:
+            old, _ = self.footprint(mode)
+            self.measured[mode] = max(peak, int(0.7 * old + 0.3 * peak))
+            if self.path:
+                _write_json(self.path, self.measured)
+
+
+class CoreSlot:
+    """The cores given to one running build. See `CoreAllocator`.
+    """
+    def __init__(self, allocator, name, weight, memory):
+        self.allocator = allocator
+        self.name = name
+        self.weight = weight
+        self.memory = memory
+        self.cpus = set()
+        self.procs = []
+        self.cgroup = None
+
+    def set_cpus(self, cpus):
+        """Move the build to a new set of cores.
+        """
+        self.cpus = cpus
+        if self.cgroup:
+            _write_cgroup(self.cgroup, 'cpuset.cpus',
+                          ','.join(str(c) for c in sorted(cpus)))
+        for proc in self.procs:
+            if proc.poll() is None:
+                set_tree_affinity(proc.pid, cpus)
+
+    def attach(self, proc):
+        """Confine a started command (a `Popen` object) to the build's
+        cores. Pass this as the `on_start` callback to `JobTask.run`.
+        """
+        with self.allocator.lock:
+            self.procs.append(proc)
+            root = self.allocator.cgroup_root
+            if root and not self.cgroup:
+                cgroup = os.path.join(root, self.name)
+                try:
+                    os.makedirs(cgroup, exist_ok=True)
+                except OSError:
+                    pass
+                else:
+                    self.cgroup = cgroup
+                    if self.memory:
+                        _write_cgroup(cgroup, 'memory.high',
+                                      str(int(self.memory)))
+            if self.cgroup and \
+                    not _write_cgroup(self.cgroup, 'cgroup.procs',
+                                      str(proc.pid)):
+                self.close()
+            self.set_cpus(self.cpus)
+
+    def close(self):
+        """Remove the build's cgroup, if it has one.
+        """
+        if self.cgroup:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError:
+                pass
+            self.cgroup = None
+
+
+class CoreAllocator:
+    """Gives each build running on this host its own set of cores, in
+    proportion to its weight, and redistributes them as builds start and
+    finish.
+
+    If `cgroup_root` is a cgroup v2 directory that we may write to, each
+    build also runs in its own child cgroup there, limited to its cores
+    and (if known) its estimated memory footprint.
+    """
+    def __init__(self, cgroup_root=None):
+        self.cores = sorted(os.sched_getaffinity(0))
+        self.cgroup_root = cgroup_root
+        self.lock = threading.RLock()
+
+        # The slots for running builds, by name.
+        self.slots = {}
+
+    @contextmanager
+    def slot(self, name, weight=1, memory=None):
+        """A context manager that reserves cores for the build called
+        `name` while it runs. Produce a `CoreSlot`.
+        """
+        slot = CoreSlot(self, name, weight, memory)
+        with self.lock:
+            self.slots[name] = slot
+            self._redistribute()
+        try:
+            yield slot
+        finally:
+            with self.lock:
+                del self.slots[name]
+                slot.close()
+                self._redistribute()
+
+    def _redistribute(self):
+        """Divide the cores between the running builds.
+        """
+        slots = list(self.slots.values())
+        cpu_sets = split_cores(self.cores, [s.weight for s in slots])
+        for slot, cpus in zip(slots, cpu_sets):
+            if cpus != slot.cpus:
+                slot.set_cpus(cpus)
+
+
+class SlotPool:
+    """Hands out numbered device slots (e.g., the FPGAs on an F1
+    instance) to the threads that run jobs on them, one job per slot at
+    a time.
+
+    The pool also keeps track of the image loaded in each slot (if
+    known), how many jobs in a row have reused it, and how long loading
+    an image takes, so that jobs can reuse images that are already
+    loaded.
+    """
+    def __init__(self, slots):
+        self.free = list(slots)
+        self.cv = threading.Condition()
+
+        self.loaded = {}
+        self.reuses = {}
+        self.load_time = None
+
+    def record_load(self, slot, image, seconds):
+        """Record that an image was loaded into a slot (or that the slot
+        is in an unknown state, if `image` is None), and how long it took.
+        """
+        with self.cv:
+            self.loaded[slot] = image
+            self.reuses[slot] = 0
+            if image and seconds is not None:
+                self.load_time = seconds if self.load_time is None else \
+                    0.7 * self.load_time + 0.3 * seconds
+
+    def record_reuse(self, slot):
+        """Record that a job reused the image loaded in a slot.
+        """
+        with self.cv:
+            self.reuses[slot] = self.reuses.get(slot, 0) + 1
+
+    @contextmanager
+    def slot(self):
+        """A context manager that waits for a free slot and reserves it.
+        Produce the slot number.
+        """
+        with self.cv:
+            while not self.free:
+                self.cv.wait()
+            slot = self.free.pop(0)
+        try:
+            yield slot
+        finally:
+            with self.cv:
+                self.free.append(slot)
+                self.cv.notify()
+
+
+# Admission controllers, core allocators, and FPGA slot pools, by instance
+# directory.
+_admissions = {}
+_allocators = {}
+_slot_pools = {}
+_admissions_lock = threading.Lock()
+
+
+def make_admission(db, config):
+    """Get the admission controller shared by the make stage's threads,
+    or None if the make stage runs a fixed number of builds (i.e.,
+    `PARALLELISM_MAKE` is set).
+    """
+    if config['PARALLELISM_MAKE']:
+        return None
+    with _admissions_lock:
+        if db.base_path not in _admissions:
+            _admissions[db.base_path] = Admission(
+                config['MAKE_FOOTPRINTS'],
+                config['MAKE_FOOTPRINT_DEFAULT'],
+                config['MAKE_MEMORY_HEADROOM'],
+                config['DEFAULT_F1_MODE'],
+                os.path.join(db.base_path, FOOTPRINTS_FILENAME),
+            )
+        return _admissions[db.base_path]
+
+
+def make_cores(db, config):
+    """Get the core allocator shared by the make stage's threads, or None
+    if builds are not confined to their own cores (`MAKE_PIN_CORES`).
+    """
+    if not (config['MAKE_PIN_CORES'] and hasattr(os, 'sched_setaffinity')):
+        return None
+    with _admissions_lock:
+        if db.base_path not in _allocators:
+            _allocators[db.base_path] = CoreAllocator(config['MAKE_CGROUP'])
+        return _allocators[db.base_path]
+
+
+def fpga_slots(db, config):
+    """Get the pool of FPGA slots (`FPGA_SLOTS`) shared by the execution
+    stage's threads.
+    """
+    with _admissions_lock:
+        if db.base_path not in _slot_pools:
+            _slot_pools[db.base_path] = SlotPool(config['FPGA_SLOTS'])
+        return _slot_pools[db.base_path]
@@ -0,0 +1,103 @@
+import time
+from collections import Counter
+
+
+def entry(job):
+    """Get the fields of a job that the scheduler (and `select` and
+    `prefer` functions) look at. These are kept in the job database's
+    state index.
+    """
+    config = job.get('config') or {}
+    mode = job.get('mode') or config.get('mode')
+    if not mode and config.get('estimate'):
+        mode = 'estimate'
+    try:
+        priority = int(config.get('priority') or 0)
+    except (TypeError, ValueError):
+        priority = 0
+    return {
+        'priority': priority,
+        'mode': mode,
+        'started': job['started'],
+        'submitter': config.get('submitter') or '',
+        'agfi': job.get('agfi_id'),
+        'skipexec': bool(config.get('estimate') or config.get('skipexec')),
+    }
+
+
+class Scheduler:
+    """Decides which of the jobs queued in a state a worker should take
+    next.
+
+    A job's effective priority is its `priority` configuration option,
+    plus a bonus for its mode from `mode_bonus` (so that quick jobs like
+    estimates do not wait behind long hardware builds), plus one for
+    every `aging` seconds since it was submitted (so that nothing waits
+    forever). Higher effective priorities go first; ties go to the job
+    submitted first. An `aging` of 0 disables aging.
+
+    Jobs queued in `share_states` are also shared fairly between
+    submitters. A submitter with `share_cap` jobs already running is
+    skipped (0 means no cap). The others take turns, starting with
+    whoever is running the fewest jobs relative to their weight in
+    `share_weights` (default 1) and then whoever was served least
+    recently; each submitter's own jobs still go in priority order.
+    """
+    def __init__(self, mode_bonus=None, aging=0, share_states=(),
+                 share_cap=0, share_weights=None):
+        self.mode_bonus = mode_bonus or {}
+        self.aging = aging
+        self.share_states = share_states
+        self.share_cap = share_cap
+        self.share_weights = share_weights or {}
+
+        # When each submitter was last served from a shared state, as a
+        # count of jobs served.
+        self.turns = {}
+        self.served = 0
+
+    def effective_priority(self, entry, now):
+        """Get the effective priority of a queued job's entry.
+        """
+        priority = entry['priority'] + self.mode_bonus.get(entry['mode'], 0)
+        if self.aging:
+            priority += int(max(now - entry['started'], 0) // self.aging)
+        return priority
+
+    def order(self, entries, now=None, running=None):
+        """Given `(name, entry)` pairs for queued jobs, return the job
+        names in the order they should be taken.
+
+        To share slots between submitters, also pass the entries for
+        the jobs already `running` (i.e., in the state being acquired
+        into).
+        """
+        now = time.time() if now is None else now
+        ranked = sorted(entries, key=lambda item: (
+            -self.effective_priority(item[1], now),
+            item[1]['started'],
+            item[0],
+        ))
+
+        if running is not None:
+            slots = Counter(e['submitter'] for e in running)
+            if self.share_cap:
+                ranked = [(n, e) for n, e in ranked
+                          if slots[e['submitter']] < self.share_cap]
+
+            # Sorting is stable, so this keeps the priority order within
+            # each submitter.
+            ranked.sort(key=lambda item: (
+                slots[item[1]['submitter']] /
+                self.share_weights.get(item[1]['submitter'], 1),
+                self.turns.get(item[1]['submitter'], 0),
+            ))
+
+        return [name for name, _ in ranked]
+
+    def took(self, entry):
+        """Record that a job was taken from a shared state, so its
+        submitter goes to the back of the line.
+        """
+        self.served += 1
+        self.turns[entry['submitter']] = self.served
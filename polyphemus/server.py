@@ -4,18 +4,26 @@ import csv
 import re
 import json
 import git
+import shutil
+import tempfile
 
 from enum import Enum
 from io import StringIO
 from datetime import datetime
 from flask import request
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
+from collections import defaultdict, Counter
 
 from . import state
 from . import workproc
-from .db import JobDB, ARCHIVE_NAME, NotFoundError, BadJobError
+from . import logs
+from . import cache
+from . import archive
+from .db import open_db, decode_cursor, ARCHIVE_NAME, CODE_DIR, \
+    NotFoundError, BadJobError
 
 INSTANCE_DIR = os.path.abspath(os.environ.get('POLYPHEMUS_DIR') or 'instance')
+UPLOAD_DIR = 'uploads'
 
 # Our Flask application.
 app = flask.Flask(__name__, instance_path=INSTANCE_DIR, instance_relative_config=True)
@@ -24,16 +32,38 @@ app = flask.Flask(__name__, instance_path=INSTANCE_DIR, instance_relative_config
 app.config.from_object('polyphemus.config_default')
 app.config.from_pyfile('polyphemus.cfg', silent=True)
 
+
+
+class UploadRequest(flask.Request):
+    """A request that streams uploaded files straight to disk in the
+    instance directory, hashing them along the way (see `add_job`).
+    """
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        upload_dir = os.path.join(app.instance_path, UPLOAD_DIR)
+        os.makedirs(upload_dir, exist_ok=True)
+        return archive.HashingFile(upload_dir)
+
+
+app.request_class = UploadRequest
+
 # Use worker threads by default in development.
 if app.config['WORKER_THREADS'] is None:
     app.config['WORKER_THREADS'] = (app.env == 'development')
 
 # Connect to our database.
-db = JobDB(app.instance_path)
+db = open_db(app.instance_path, app.config)
 
 # Start socketio.
 socketio = SocketIO(app)
 
+# Socket.IO clients following each job's log (by session ID), how far
+# each followed log has been sent to them, and whether the background task
+# that pushes log updates to them is running.
+log_followers = defaultdict(set)
+log_offsets = {}
+log_pusher_started = False
+
 STATUS_STRINGS = {
     state.UPLOAD: "Uploaded",
     state.UNPACK: "Unpacking",
@@ -42,11 +72,19 @@ STATUS_STRINGS = {
     state.MAKE_PROGRESS: "Makeing",
     state.AFI_START: "Start AFI",
     state.AFI: "Generating AFI",
+    state.AFI_PENDING: "Waiting for AFI",
     state.RUN: "Running",
     state.DONE: "Done",
     state.FAIL: "Failed",
 }
 
+# The states of jobs whose hardware build is finished, so run-only jobs
+# can use them as parents, and the build options run-only jobs take from
+# their parents.
+RUNNABLE_STATES = state.HLS_FINISH, state.RUN, state.DONE
+RUN_ONLY_INHERITED = ['estimate', 'make', 'directives', 'platform', 'mode',
+                      'make_conf']
+
 
 def git_commit_sha():
     sha = git.Repo().head.object.hexsha[:7]
@@ -115,14 +153,77 @@ def notify_workers(jobname):
 
 def get_config(values):
     """Get the job configuration options specified by data in the given
-    form values.
+    form values. Raise a ValueError if a value cannot be converted.
     """
     config = {}
     for key, typ in app.config['CONFIG_OPTIONS'].items():
-        config[key] = typ(values.get(key, ''))
+        value = values.get(key, '')
+        try:
+            config[key] = typ(value)
+        except ValueError:
+            raise ValueError('invalid {}: {}'.format(key, value))
     return config
 
 
+def _parse_time(value):
+    """Parse a timestamp given either as seconds since the epoch or as
+    an ISO 8601 date (and optional time).
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def get_query(values, limit=True):
+    """Get the job listing filters and pagination options from the given
+    request values, as keyword arguments for `db.query`. Abort with a
+    400 error if they are invalid. If `limit` is False, there is no
+    default page size.
+    """
+    query = {}
+    for key in ('cursor', 'state', 'mode', 'hwname'):
+        if values.get(key):
+            query[key] = values[key]
+
+    try:
+        for key in ('since', 'until'):
+            if values.get(key):
+                query[key] = _parse_time(values[key])
+        if values.get('limit'):
+            query['limit'] = min(int(values['limit']),
+                                 app.config['JOBS_PAGE_MAX'])
+        elif limit:
+            query['limit'] = app.config['JOBS_PAGE_SIZE']
+        if 'cursor' in query:
+            decode_cursor(query['cursor'])
+    except ValueError as exc:
+        flask.abort(400, 'Invalid job query: {}'.format(exc))
+
+    return query
+
+
+def share_usage():
+    """Summarize how the make slots are shared between submitters: for
+    each submitter with jobs running or waiting in the make stage, the
+    number of each and their weight.
+    """
+    running, _ = db.query(state=state.MAKE_PROGRESS)
+    waiting, _ = db.query(state=state.MAKE)
+    running = Counter(r.get('submitter') or '' for r in running)
+    waiting = Counter(r.get('submitter') or '' for r in waiting)
+    weights = app.config['MAKE_SHARE_WEIGHTS']
+    return [
+        {
+            'submitter': submitter,
+            'running': running[submitter],
+            'waiting': waiting[submitter],
+            'weight': weights.get(submitter, 1),
+        }
+        for submitter in sorted(running.keys() | waiting.keys())
+    ]
+
+
 def list_files(job_name):
     """Generate the paths to all the job's files.
     """
@@ -137,7 +238,28 @@ def list_files(job_name):
 # Upload a job to the server.
 @app.route('/jobs', methods=['POST'])
 def add_job():
-    config = get_config(request.values)
+    try:
+        config = get_config(request.values)
+    except ValueError as exc:
+        return str(exc), 400
+    config['submitter'] = config['submitter'] or \
+        request.headers.get(app.config['SUBMITTER_HEADER']) or \
+        request.remote_addr or ''
+
+    # Run-only jobs reuse their parent job's hardware build, so they
+    # also use its build options.
+    if config['parent']:
+        try:
+            parent = db.get(config['parent'])
+        except NotFoundError:
+            return 'unknown parent job {}'.format(config['parent']), 400
+        if parent['state'] not in RUNNABLE_STATES:
+            return 'parent job {} has no finished build'.format(
+                config['parent']
+            ), 400
+        for key in RUN_ONLY_INHERITED:
+            config[key] = parent['config'].get(key)
+        config['hwname'] = config['hwname'] or parent['config'].get('hwname')
 
     # Get the code either from an archive or a parameter.
     if 'file' in request.files:
@@ -148,9 +270,60 @@ def add_job():
         if ext[1:] not in app.config['UPLOAD_EXTENSIONS']:
             return 'invalid extension {}'.format(ext), 400
 
-        # Create the job and save the archive file.
-        with db.create(state.UPLOAD, config) as name:
-            file.save(ARCHIVE_NAME + ext)
+        # The upload was already streamed to a temporary file and hashed
+        # (see `UploadRequest`). Check that it is a usable archive.
+        upload = file.stream
+        upload.flush()
+        try:
+            size = archive.validate(upload.name,
+                                    app.config['UNPACK_MAX_FILES'],
+                                    app.config['UNPACK_MAX_SIZE'])
+        except archive.ArchiveError as exc:
+            return str(exc), 400
+
+        # Identify the build for the build cache.
+        build_cache = cache.BuildCache.open(db, app.config)
+        cached = False
+        if build_cache and not config['parent']:
+            config['cache_key'] = cache.job_key(upload.hexdigest(), config,
+                                                app.config)
+            cached = build_cache.has(config['cache_key'])
+
+        # Extract small archives right away, so the job can skip the
+        # unpack stage (unless it needs to reuse another build there).
+        extract_dir = None
+        if size <= app.config['UPLOAD_EXTRACT_SIZE'] and \
+                not config['parent'] and not cached:
+            extract_dir = tempfile.mkdtemp(dir=os.path.dirname(upload.name))
+            try:
+                prefix = archive.extract(
+                    upload.name, os.path.join(extract_dir, CODE_DIR),
+                    app.config['UNPACK_MAX_FILES'],
+                    app.config['UNPACK_MAX_SIZE'],
+                )
+            except archive.ArchiveError as exc:
+                shutil.rmtree(extract_dir)
+                return str(exc), 400
+            except BaseException:
+                shutil.rmtree(extract_dir)
+                raise
+
+        # Create the job and move the archive (and code) into place.
+        initial_state = state.MAKE if extract_dir else state.UPLOAD
+        with db.create(initial_state, config) as name:
+            try:
+                os.link(upload.name, ARCHIVE_NAME + ext)
+            except OSError:
+                shutil.copyfile(upload.name, ARCHIVE_NAME + ext)
+            if extract_dir:
+                os.rename(os.path.join(extract_dir, CODE_DIR), CODE_DIR)
+        if extract_dir:
+            os.rmdir(extract_dir)
+            db.log(name, 'unpacked at upload')
+            if prefix:
+                db.log(name, 'collapsed directory {}'.format(
+                    prefix.rstrip('/')
+                ))
         notify_workers(name)
 
     else:
@@ -173,27 +346,48 @@ def jobs_csv():
     )
     writer.writeheader()
 
-    for job in db._all():
+    rows, _ = db.query(**get_query(request.args, limit=False))
+    for row in rows:
         writer.writerow({
-            'id': job['name'],
-            'name': job['config'] and job['config']['hwname'],
-            'started': job['started'],
-            'state': job['state'],
+            'id': row['name'],
+            'name': row['hwname'],
+            'started': row['started'],
+            'state': row['state'],
         })
 
     csv_data = output.getvalue()
     return csv_data, 200, {'Content-Type': 'text/csv'}
 
 
-# Get the list of all jobs.
+# Get a page of the list of jobs as JSON.
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    rows, cursor = db.query(**get_query(request.args))
+    return flask.jsonify({'jobs': rows, 'next': cursor})
+
+
+# Get a page of the list of jobs.
 @app.route('/')
 def jobs_html():
     sha, link = git_commit_sha()
+    query = get_query(request.args)
+    rows, cursor = db.query(**query)
+
+    # Link to the next page with the same filters.
+    next_url = None
+    if cursor:
+        args = request.args.to_dict()
+        args['cursor'] = cursor
+        next_url = flask.url_for('jobs_html', **args)
+
     return flask.render_template(
         'joblist.html',
         commit={'sha': sha, 'link': link},
-        jobs=db._all(),
+        jobs=rows,
+        query=request.args,
+        next_url=next_url,
         status_strings=STATUS_STRINGS,
+        share_usage=share_usage(),
     )
 
 
@@ -214,28 +408,43 @@ def show_job(name):
         # Is this a name change request?
         elif 'hwname' in request.form:
             new_name = request.form['hwname']
-            job['config']['hwname'] = new_name
+            job = db.set_config(job['name'], 'hwname', new_name)
             db.log(job['name'], 'hwname changed to {}'.format(new_name))
-            db._write(job)
+
+        # Is this a priority change request?
+        elif 'priority' in request.form:
+            try:
+                new_priority = int(request.form['priority'])
+            except ValueError:
+                flask.abort(400, 'Invalid priority.')
+            job = db.set_config(job['name'], 'priority', new_priority)
+            db.log(job['name'],
+                   'priority changed to {}'.format(new_priority))
+            notify_workers(job['name'])
 
         else:
             flask.abort(500, 'Unknown POST request.')
 
 
-    # Construct regex for interesting words
-    interest_regex = re.compile('|'.join(app.config['IMPORTANT_WORDS']), re.I)
-
-    # Get the last few lines and interesting lines from the log.
+    # Get a page of interesting lines from the log's index.
+    page_size = app.config['INTERESTING_PAGE_SIZE']
+    try:
+        page = max(int(request.args.get('important', 1)), 1)
+    except ValueError:
+        page = 1
+    interesting_lines, interesting_count = \
+        db.interesting(name, (page - 1) * page_size, page_size)
+    interesting_pages = -(-interesting_count // page_size)
+
+    # Get the last few lines from the log, and where the log ends so the
+    # page can follow it from there.
     log_filename = db._log_path(name)
-    lines = app.config['LOG_PREVIEW_LINES']
     try:
-        with open(log_filename) as f:
-            file = list(f)
-            log_lines = file[-lines:]
-            interesting_lines = [l for l in file if interest_regex.search(l)]
+        log = logs.tail(log_filename, app.config['LOG_PREVIEW_LINES'])
+        log_offset = logs.size(log_filename)
     except IOError:
-        log_lines = []
-        interesting_lines = []
+        log = ''
+        log_offset = 0
 
     return flask.render_template(
         'job.html',
@@ -243,15 +452,48 @@ def show_job(name):
         json_config=json.dumps(job['config'], indent=4, sort_keys=True),
         status_strings=STATUS_STRINGS,
         update_states=state.UNLOCKED_STATES,
-        log=''.join(log_lines),
-        interesting=''.join(interesting_lines),
+        log=log,
+        log_offset=log_offset,
+        interesting='\n'.join(e['line'] for e in interesting_lines),
+        interesting_page=page,
+        interesting_pages=interesting_pages,
     )
 
 
 @app.route('/jobs/<name>/log.txt')
 def job_log(name):
+    """Serve a job's log, reassembled from its segments. Supports
+    single byte-range requests, so clients can fetch just part of a
+    long log.
+    """
     filename = db._log_path(name)
-    return flask.send_file(filename)
+    try:
+        size = logs.size(filename)
+    except FileNotFoundError:
+        flask.abort(404)
+
+    start, end = 0, size
+    status = 200
+    if request.range and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return flask.Response(status=416, headers={
+                'Content-Range': 'bytes */{}'.format(size),
+            })
+        start, end = byte_range
+        status = 206
+
+    response = flask.Response(
+        logs.read_range(filename, start, end),
+        status=status,
+        mimetype='text/plain',
+    )
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Length'] = str(end - start)
+    if status == 206:
+        response.headers['Content-Range'] = \
+            'bytes {}-{}/{}'.format(start, end - 1, size)
+    return response
 
 
 @app.route('/jobs/<name>/files.html')
@@ -289,15 +531,60 @@ def job_file(name, filename):
     return flask.send_from_directory(db.job_dir(name), filename, mimetype=mime)
 
 
-@socketio.on('update log')
-def update_log(job_name):
-    try:
-        log_filename = db._log_path(job_name)
-        lines = app.config['LOG_PREVIEW_LINES']
-        with open(log_filename, 'r') as f:
-            file = list(f)
-            log_lines = file[-lines:]
-            return { 'status': 'ok', 'data': ''.join(log_lines) }
-    except IOError:
-        return { 'status': 'failed' }
+def _read_log(job_name, offset):
+    """Read the part of a job's log after `offset` (in bytes) as a
+    message for Socket.IO clients.
+    """
+    text, start, end = logs.read_from(db._log_path(job_name), offset,
+                                      app.config['LOG_PUSH_MAX'])
+    return {'status': 'ok', 'data': text, 'offset': start, 'next': end}
+
 
+def push_logs():
+    """Background task: push newly appended log lines to the clients
+    following each log, whenever the log grows.
+    """
+    while True:
+        socketio.sleep(app.config['LOG_PUSH_INTERVAL'])
+        for job_name in [n for n, sids in log_followers.items() if sids]:
+            try:
+                size = logs.size(db._log_path(job_name))
+            except OSError:
+                continue
+            if size > log_offsets.get(job_name, size):
+                msg = _read_log(job_name, log_offsets[job_name])
+                log_offsets[job_name] = msg['next']
+                if msg['data']:
+                    socketio.emit('log data', msg, room='log:' + job_name)
+
+
+@socketio.on('follow log')
+def follow_log(job_name, offset):
+    """Start following a job's log from a byte offset. Return the lines
+    appended since then; later lines are pushed as `log data` events.
+    """
+    global log_pusher_started
+    if not log_pusher_started:
+        log_pusher_started = True
+        socketio.start_background_task(push_logs)
+
+    join_room('log:' + job_name)
+    log_followers[job_name].add(request.sid)
+    try:
+        msg = _read_log(job_name, int(offset))
+    except (IOError, ValueError):
+        return {'status': 'failed'}
+
+    # Push lines after the ones this client has now seen.
+    log_offsets.setdefault(job_name, msg['next'])
+    return msg
+
+
+@socketio.on('disconnect')
+def unfollow_logs():
+    # Forget the push offsets of logs nobody follows anymore.
+    for job_name, sids in list(log_followers.items()):
+        sids.discard(request.sid)
+        if not sids:
+            del log_followers[job_name]
+            log_offsets.pop(job_name, None)
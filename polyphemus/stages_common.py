@@ -1,12 +1,24 @@
+import hashlib
+import json
 import os
 import re
 import shlex
 import subprocess
+import threading
 import traceback
 
 from . import state
-from .db import ARCHIVE_NAME, CODE_DIR
-from contextlib import contextmanager
+from . import scheduler
+from .db import ARCHIVE_NAME, CODE_DIR, _write_json
+from .logs import LineBuffer
+from .resources import PeakMonitor
+from contextlib import contextmanager, nullcontext
+
+# The directory (in the instance directory) where make configurations
+# extracted by `update_make_conf` are cached, and the names of makefiles
+# whose contents identify a configuration.
+MAKE_CONF_DIR = 'make_conf'
+MAKEFILE_NAMES = ('Makefile', 'makefile', 'GNUmakefile')
 
 def _cmd_str(cmd):
     """Given a list of command-line arguments, return a human-readable
@@ -60,13 +72,19 @@ class JobTask:
         """
         self.db.set_state(self.job, state)
 
-    def run(self, cmd, capture=False, timeout=60, cwd='', **kwargs):
+    def run(self, cmd, capture=False, timeout=60, cwd='', on_start=None,
+            **kwargs):
         """Run a command and log its output.
 
         Return an exited process object. If `capture`, then the
         standard output is *not* logged and is instead available as the return
-        value's `stdout` field. Additional arguments are forwarded to
-        `subprocess.run`.
+        value's `stdout` field. If `capture` is a function, it is instead
+        called with each line of standard output as it arrives. If given,
+        `on_start` is called with the `Popen` object once the command has
+        started. Additional arguments are forwarded to `subprocess.Popen`.
+
+        The output is passed through the job log in whole lines, so
+        interesting lines are indexed as they are written.
 
         Raise an appropriate `WorkError` if the command fails.
         """
@@ -74,38 +92,79 @@ class JobTask:
 
         self.log('$ {}'.format(_cmd_str(cmd)))
 
-        log_filename = self.db._log_path(self.job['name'])
-        with open(log_filename, 'ab') as f:
-            try:
-                return subprocess.run(
-                    cmd,
-                    check=True,
-                    stdout=subprocess.PIPE if capture else f,
-                    stderr=f,
-                    timeout=timeout,
-                    cwd=full_cwd,
-                    **kwargs,
-                )
-            except subprocess.CalledProcessError as exc:
-                raise WorkError('command failed ({})'.format(
-                    exc.returncode,
-                ))
-            except FileNotFoundError as exc:
-                raise WorkError('command {} not found'.format(
-                    exc.filename,
-                ))
-            except subprocess.TimeoutExpired as exc:
-                raise WorkError('timeout after {} seconds'.format(
-                    exc.timeout,
-                ))
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE if capture else subprocess.STDOUT,
+                cwd=full_cwd,
+                **kwargs,
+            )
+        except FileNotFoundError as exc:
+            raise WorkError('command {} not found'.format(
+                exc.filename,
+            ))
+
+        # Copy the output to the log (and collect the captured output) in
+        # background threads.
+        log_stream = proc.stderr if capture else proc.stdout
+        output = []
+        pumps = [threading.Thread(target=self._pump, args=(log_stream,))]
+        if callable(capture):
+            pumps.append(threading.Thread(
+                target=lambda: [capture(line) for line in proc.stdout]
+            ))
+        elif capture:
+            pumps.append(threading.Thread(
+                target=lambda: output.append(proc.stdout.read())
+            ))
+        for pump in pumps:
+            pump.start()
+        if on_start:
+            on_start(proc)
+
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired as exc:
+            proc.kill()
+            proc.wait()
+            raise WorkError('timeout after {} seconds'.format(
+                exc.timeout,
+            ))
+        finally:
+            for pump in pumps:
+                # Don't wait forever for output from orphaned children.
+                pump.join(timeout=10)
+
+        if proc.returncode:
+            raise WorkError('command failed ({})'.format(
+                proc.returncode,
+            ))
+        return subprocess.CompletedProcess(
+            cmd, proc.returncode,
+            stdout=b''.join(output) if capture is True else None,
+        )
+
+    def _pump(self, stream):
+        """Copy a command's output stream to the job log, line by line.
+        """
+        lines = LineBuffer(lambda data: self.db.log_output(self.job['name'],
+                                                           data))
+        with stream:
+            for chunk in iter(lambda: stream.read1(64 * 1024), b''):
+                lines.write(chunk)
+        lines.close()
 
 
 @contextmanager
-def work(db, old_state, temp_state, done_state_or_func):
+def work(db, old_state, temp_state, done_state_or_func, select=None,
+         prefer=None):
     """A context manager for acquiring a job temporarily in an
     exclusive way to work on it. Produce a `JobTask`.
     Done state can either be a valid state string or a function that
-    accepts a Task object and returns a valid state string.
+    accepts a Task object and returns a valid state string. If given,
+    `select` limits which jobs are acquired and `prefer` picks the ones
+    to take first (see `JobDB.acquire`).
     """
     done_func = None
     if isinstance(done_state_or_func, str):
@@ -113,7 +172,7 @@ def work(db, old_state, temp_state, done_state_or_func):
     else:
         done_func = done_state_or_func
 
-    job = db.acquire(old_state, temp_state)
+    job = db.acquire(old_state, temp_state, select, prefer)
     task = JobTask(db, job)
     try:
         yield task
@@ -140,25 +199,153 @@ def task_config(task, config):
         config['DEFAULT_F1_MODE']
 
 
+def run_make(task, make_cmd, admission, cores, **kwargs):
+    """Run a job's main make command. With an admission controller (see
+    `resources.make_admission`), measure the build's peak memory use to
+    refine its estimates. With a core allocator (see
+    `resources.make_cores`), confine the build to its own cores and tell
+    make to run that many jobs at once. Additional arguments go to
+    `JobTask.run`.
+    """
+    mode = scheduler.entry(task.job)['mode']
+    weight, memory = 1, None
+    if admission:
+        memory, weight = admission.footprint(mode)
+
+    callbacks = []
+    monitor = PeakMonitor()
+    if admission:
+        callbacks.append(monitor.start)
+
+    slot_context = cores.slot(task['name'], weight, memory) if cores \
+        else nullcontext()
+    with slot_context as slot:
+        if slot:
+            task.log('running on cores {}'.format(
+                ','.join(str(c) for c in sorted(slot.cpus))
+            ))
+            make_cmd = make_cmd + ['-j{}'.format(len(slot.cpus))]
+            callbacks.append(slot.attach)
+
+        proc = task.run(
+            make_cmd,
+            on_start=lambda p: [callback(p) for callback in callbacks],
+            **kwargs
+        )
+
+    if admission:
+        admission.record(mode, monitor.peak)
+    return proc
+
+
+def _hash_file(path):
+    """Get the SHA-256 digest of a file's contents as a hex string, or
+    None if it cannot be read.
+    """
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def _make_conf_key(make_cmd, code_dir, config):
+    """Get the cache key for a make configuration: a hash of the make
+    command, the variables to extract, and the makefiles in the job's
+    code.
+    """
+    h = hashlib.sha256(json.dumps(
+        [make_cmd, config['MAKE_CONF_VARS']]
+    ).encode('utf8'))
+    makefiles = []
+    for dirpath, _, filenames in os.walk(code_dir):
+        for fn in filenames:
+            if fn in MAKEFILE_NAMES or fn.endswith('.mk'):
+                makefiles.append(os.path.relpath(os.path.join(dirpath, fn),
+                                                 code_dir))
+    for path in sorted(makefiles):
+        h.update(path.encode('utf8') + b'\0')
+        h.update((_hash_file(os.path.join(code_dir, path)) or '')
+                 .encode('ascii'))
+    return h.hexdigest()
+
+
+def _cached_make_conf(path):
+    """Read a cached make configuration, or return None if there is none
+    or if any of the makefiles outside the job's code that it was read
+    from have changed since.
+    """
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (IOError, json.JSONDecodeError):
+        return None
+    for makefile, digest in entry['makefiles'].items():
+        if _hash_file(makefile) != digest:
+            return None
+    return entry['make_conf']
+
+
 def update_make_conf(make_cmd, task, db, config):
     """Extract configuration variables from a make job and update the config
     object with them.
+
+    The variables are extracted from make's database, which takes a dry
+    run. Unless `MAKE_CONF_CACHE` is off, the results are cached by the
+    command and the contents of the makefiles (including those included
+    from elsewhere), so builds with the same makefiles skip the dry run.
     """
+    cache_path = None
+    make_conf = None
+    if config['MAKE_CONF_CACHE']:
+        key = _make_conf_key(make_cmd, task.code_dir, config)
+        cache_path = os.path.join(db.base_path, MAKE_CONF_DIR,
+                                  '{}.json'.format(key))
+        make_conf = _cached_make_conf(cache_path)
+        if make_conf is not None:
+            task.log('make conf from cache')
 
-    # Before running the make target, collect configuration information.
-    proc = task.run(make_cmd + ['--dry-run', '--print-data-base'],
-                    capture=True, cwd=CODE_DIR)
-    log = proc.stdout.decode('utf8').strip()
+    if make_conf is None:
+        # Before running the make target, collect configuration
+        # information. Extract the relevant options from make's database
+        # as it is printed, along with the list of makefiles it read.
+        conf_str = r"^\s*({})\s*:?=\s*(.*)$".format('|'.join(config['MAKE_CONF_VARS']))
+        conf_re = re.compile(conf_str, re.I)
+        list_re = re.compile(r'^MAKEFILE_LIST\s*:?=\s*(.*)$')
 
-    # Extract relevant conf options.
-    conf_str = r"^\s*({})\s*:?=\s*(.*)$".format('|'.join(config['MAKE_CONF_VARS']))
-    conf_re = re.compile(conf_str, re.I)
+        make_conf = {}
+        makefile_list = []
 
-    make_conf = {}
-    for line in log.split('\n'):
-        matches = conf_re.search(line.strip())
-        if matches:
-            make_conf[matches.group(1)] = matches.group(2)
+        def parse(line):
+            line = line.decode('utf8', 'replace').strip()
+            matches = conf_re.search(line)
+            if matches:
+                make_conf[matches.group(1)] = matches.group(2)
+            matches = list_re.search(line)
+            if matches:
+                makefile_list[:] = matches.group(1).split()
+
+        task.run(make_cmd + ['--dry-run', '--print-data-base'],
+                 capture=parse, cwd=CODE_DIR)
+
+        if cache_path:
+            # The job's own makefiles are part of the key, so only those
+            # included from elsewhere (e.g., a platform's shared rules)
+            # need to be checked when the entry is used.
+            code_dir = os.path.realpath(task.code_dir)
+            makefiles = {}
+            for makefile in makefile_list:
+                makefile = os.path.realpath(
+                    os.path.join(task.code_dir, makefile)
+                )
+                if os.path.commonpath([makefile, code_dir]) != code_dir:
+                    makefiles[makefile] = _hash_file(makefile)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            _write_json(cache_path,
+                        {'make_conf': make_conf, 'makefiles': makefiles})
 
     # Update the job config with make_conf
     task.job['config']['make_conf'] = make_conf
@@ -13,7 +13,9 @@
 #         |                     |
 #         |                 AFI_START (F1 only)
 #         |                     |
-#         +---------------<AFI> (F1 only)
+#         |                   <AFI> (F1 only)
+#         |                     |
+#         +---------------AFI_PENDING (F1 only)
 #         |
 #     HLS_FINISH
 #         |
@@ -31,8 +33,11 @@ MAKE_PROGRESS = "makeing"
 HLS_FINISH = "hlsed"
 AFI_START = "starting_AFI"
 AFI = "generating_AFI"
+AFI_PENDING = "pending_AFI"
 RUN = "fpga_executing"
 DONE = "done"
 FAIL = "failed"
 
-UNLOCKED_STATES = MAKE, AFI_START, HLS_FINISH, DONE, FAIL
+UNLOCKED_STATES = MAKE, AFI_START, AFI_PENDING, HLS_FINISH, DONE, FAIL
+LOCKED_STATES = UNPACK, MAKE_PROGRESS, AFI, RUN
+FINAL_STATES = DONE, FAIL
@@ -0,0 +1,93 @@
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+
+from .stages_common import WorkError
+
+# Variables that bash sets for itself, which are not part of the captured
+# environment.
+SHELL_VARS = {'_', 'SHLVL', 'PWD', 'OLDPWD'}
+
+# Captured environments, by setup script path and whether they were
+# captured from a clean environment, as `(mtime, env)` pairs.
+_envs = {}
+_envs_lock = threading.Lock()
+
+
+def _bash_env(command, cwd=None, timeout=120, clean=False):
+    """Run a bash command and then `env -0`, and return the resulting
+    environment as a dict. With `clean`, start from an empty environment
+    instead of the worker's own.
+    """
+    cmd = [shutil.which('bash') or '/bin/bash', '-c',
+           '{} && env -0'.format(command)]
+    if clean:
+        cmd = ['env', '-i'] + cmd
+    proc = subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        timeout=timeout,
+    )
+    if proc.returncode:
+        raise WorkError('{} failed ({}): {}'.format(
+            command, proc.returncode,
+            proc.stderr.decode('utf8', 'replace').strip(),
+        ))
+
+    env = {}
+    for item in proc.stdout.split(b'\0'):
+        key, sep, value = item.decode('utf8', 'replace').partition('=')
+        if sep and key not in SHELL_VARS:
+            env[key] = value
+    return env
+
+
+def capture_env(script, cwd=None, clean=False):
+    """Source a shell setup script (e.g., a toolchain's `setup.sh`) in
+    bash and return the environment it leaves behind, as a dict.
+
+    With `clean`, source the script in an empty environment and return
+    only the variables that it sets or changes.
+    """
+    command = 'source {} > /dev/null'.format(shlex.quote(script))
+    env = _bash_env(command, cwd, clean=clean)
+    if clean:
+        base = _bash_env('true', cwd, clean=True)
+        env = {k: v for k, v in env.items() if base.get(k) != v}
+    return env
+
+
+def setup_env(task, script, cwd=None, clean=False):
+    """Get the environment set up by a shell script, to pass to
+    `JobTask.run` as `env`. With `clean`, get only the variables that
+    the script sets (see `capture_env`). Each script is only sourced
+    once per worker process, and again whenever it is modified.
+    """
+    try:
+        mtime = os.stat(script).st_mtime
+    except OSError:
+        raise WorkError('setup script {} not found'.format(script))
+
+    with _envs_lock:
+        cached = _envs.get((script, clean))
+        if cached and cached[0] == mtime:
+            return dict(cached[1])
+
+        env = capture_env(script, cwd, clean)
+        _envs[script, clean] = (mtime, env)
+        task.log('captured environment from {}'.format(script))
+        return dict(env)
+
+
+def sudo_env(env):
+    """Get the prefix for a `sudo` command that runs with the variables
+    in `env` (e.g., those set by a setup script; see `setup_env`). sudo
+    resets the environment, so all of them are passed explicitly.
+    """
+    return ['sudo', 'env'] + [
+        '{}={}'.format(k, v) for k, v in sorted(env.items())
+    ]
@@ -10,7 +10,8 @@ from .worker_common import stage_unpack
 from . import state
 from .db import CODE_DIR
 
-from .worker_f1 import stage_f1_make, stage_afi, stage_f1_fpga_execute
+from .worker_f1 import stage_f1_make, stage_afi, stage_afi_watch, \
+    stage_f1_fpga_execute, stage_f1_hw_execute, stage_f1_emu_execute
 from .worker_sdsoc import stage_sdsoc_make, stage_zynq_fpga_execute
 
 # Strings corresponding to stages known to workers.
@@ -19,10 +20,30 @@ KNOWN_STAGES = {
     "make_f1": stage_f1_make,
     "make_sdsoc": stage_sdsoc_make,
     "afi": stage_afi,
+    "afi_watch": stage_afi_watch,
     "exec_f1": stage_f1_fpga_execute,
+    "exec_f1_hw": stage_f1_hw_execute,
+    "exec_f1_emu": stage_f1_emu_execute,
     "exec_zynq": stage_zynq_fpga_execute,
 }
 
+# Pairs of stages that cannot run in the same workproc. Each `exec_f1_hw`
+# thread holds an FPGA slot while it waits for a job, so an `exec_f1` thread
+# that takes a hardware job could wait for a free slot forever.
+CONFLICTING_STAGES = [
+    ("exec_f1", "exec_f1_hw"),
+]
+
+
+def check_stages(stages_conf):
+    """Check that a list of stage names can run together in one
+    workproc. Raise a ValueError if not.
+    """
+    for a, b in CONFLICTING_STAGES:
+        if a in stages_conf and b in stages_conf:
+            raise ValueError('stages {} and {} cannot run in the same '
+                             'workproc'.format(a, b))
+
 
 class WorkThread(threading.Thread):
     """A base class for all our worker threads, which run indefinitely
@@ -30,7 +51,8 @@ class WorkThread(threading.Thread):
 
     The thread takes the database and configuration dictionaries as well
     as a function to which these will be passed. When the thread runs,
-    the function is invoked repeatedly, indefinitely.
+    the function is invoked repeatedly, indefinitely. A companion
+    heartbeat thread keeps the leases on the jobs it acquires alive.
     """
 
     def __init__(self, db, config, func):
@@ -40,9 +62,17 @@ class WorkThread(threading.Thread):
         super(WorkThread, self).__init__(daemon=True)
 
     def run(self):
+        threading.Thread(target=self.heartbeat, daemon=True).start()
         while True:
             self.func(self.db, self.config)
 
+    def heartbeat(self):
+        """Periodically renew the leases on jobs held by this thread.
+        """
+        while True:
+            time.sleep(self.config['LEASE_HEARTBEAT'])
+            self.db.renew_leases(self.ident)
+
 
 def default_work_stages(config):
     """List of functions for the configured toolchain.
@@ -53,11 +83,20 @@ def default_work_stages(config):
     stages = [stage_unpack, stage_make]
 
     if config['TOOLCHAIN'] == 'f1':
-        stages += stage_afi, stage_f1_fpga_execute
+        # One execution thread for each FPGA slot, plus some for
+        # emulation runs, which do not need a slot.
+        stages += stage_afi, stage_afi_watch
+        stages += [stage_f1_hw_execute for slot in config['FPGA_SLOTS']]
+        stages += [stage_f1_emu_execute
+                   for i in range(config['PARALLELISM_EXEC_EMU'])]
     else:
         stages += [stage_zynq_fpga_execute]
 
-    stages += [stage_make for i in range(config['PARALLELISM_MAKE'] - 1)]
+    # With adaptive make parallelism, start enough make threads for the
+    # most builds that may run at once; each only takes a job when the
+    # host has room for it.
+    parallelism = config['PARALLELISM_MAKE'] or config['MAKE_MAX_BUILDS']
+    stages += [stage_make for i in range(parallelism - 1)]
 
     return stages
 
@@ -1,26 +1,93 @@
 import os
+import shutil
 
 from . import state
-from .stages_common import work
-from .db import ARCHIVE_NAME
+from . import archive
+from .stages_common import work, task_config, WorkError
+from .db import ARCHIVE_NAME, CODE_DIR
+from .cache import BuildCache, RESULT_FIELDS
 
 
-def stage_unpack(db, _):
-    """Work stage: unpack source code.
+def _link_or_copy(src, dest):
+    """Hard-link a file, or copy it if it cannot be linked (e.g., across
+    file systems).
     """
-    with work(db, state.UPLOAD, state.UNPACK, state.MAKE) as task:
-        # Unzip the archive into the code directory.
-        os.mkdir(task.code_dir)
-        task.run(["unzip", "-d", task.code_dir, "{}.zip".format(ARCHIVE_NAME)])
-
-        # Check for single-directory zip files: if the code directory
-        # only contains one subdirectory now, "collapse" it.
-        code_contents = os.listdir(task.code_dir)
-        if len(code_contents) == 1:
-            path = os.path.join(task.code_dir, code_contents[0])
-            if os.path.isdir(path):
-                for fn in os.listdir(path):
-                    os.rename(os.path.join(path, fn),
-                              os.path.join(task.code_dir, fn))
-                task.log('collapsed directory {}'.format(code_contents[0]))
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
 
+
+def use_parent_build(task, db, config):
+    """Prepare a run-only job: link the hardware build artifacts of its
+    parent job into its code directory and build just the host code.
+    """
+    parent = task['config']['parent']
+    parent_code_dir = os.path.join(db.job_dir(parent), CODE_DIR)
+    for artifact in config['RUN_ONLY_ARTIFACTS']:
+        src = os.path.join(parent_code_dir, artifact)
+        dest = os.path.join(task.code_dir, artifact)
+        if not os.path.exists(src) or os.path.exists(dest):
+            continue
+        if os.path.isdir(src):
+            shutil.copytree(src, dest, symlinks=True,
+                            copy_function=_link_or_copy)
+        else:
+            _link_or_copy(src, dest)
+        task.log('using {} from job {}'.format(artifact, parent))
+    parent_job = db.get(parent)
+    task.job.update({k: parent_job[k] for k in RESULT_FIELDS
+                     if parent_job.get(k)})
+
+    # Build the host code with the same variables as the parent's build.
+    task_config(task, config)
+    make_conf = task['config'].get('make_conf') or {}
+    task.run(
+        config['HLS_COMMAND_PREFIX'] + [
+            'make',
+            config['HOST_MAKE_TARGET'],
+            'MODE={}'.format(task['mode']),
+        ] + ['{}={}'.format(k, v) for k, v in make_conf.items()],
+        timeout=config['COMPILE_TIMEOUT'],
+        cwd=CODE_DIR,
+    )
+
+
+def stage_unpack(db, config):
+    """Work stage: unpack source code. If the build cache has results for
+    an identical job, use those instead and skip the build. Run-only
+    jobs (with a `parent` job) skip the hardware build too, and just
+    build their host code.
+    """
+    build_cache = BuildCache.open(db, config)
+    skip_to = {}
+
+    def next_state(task):
+        return skip_to.get('state') or state.MAKE
+
+    with work(db, state.UPLOAD, state.UNPACK, next_state) as task:
+        if build_cache:
+            skip_to['state'] = build_cache.restore(task)
+        if skip_to.get('state'):
+            task_config(task, config)
+            return
+
+        # Extract the archive into the code directory. If everything is
+        # in a single directory, "collapse" it.
+        archive_path = os.path.join(task.dir, '{}.zip'.format(ARCHIVE_NAME))
+        threads = 1
+        if os.path.getsize(archive_path) >= config['UNPACK_PARALLEL_SIZE']:
+            threads = config['UNPACK_THREADS']
+        try:
+            prefix = archive.extract(archive_path, task.code_dir,
+                                     config['UNPACK_MAX_FILES'],
+                                     config['UNPACK_MAX_SIZE'], threads)
+        except archive.ArchiveError as exc:
+            raise WorkError(str(exc))
+        task.log('unpacked {}'.format(os.path.basename(archive_path)))
+        if prefix:
+            task.log('collapsed directory {}'.format(prefix.rstrip('/')))
+
+        if task['config'].get('parent'):
+            use_parent_build(task, db, config)
+            skip_to['state'] = state.HLS_FINISH
@@ -2,33 +2,39 @@ import os
 import glob
 import json
 import time
-import shutil
+import subprocess
+import traceback
 
 from . import state, modes_f1
-from .stages_common import work, task_config, update_make_conf
+from .stages_common import work, task_config, update_make_conf, run_make, \
+    WorkError, JobTask
+from .toolenv import setup_env, sudo_env
+from .resources import make_admission, make_cores, fpga_slots
+from .cache import BuildCache
+from .workspace import Workspace
 from .db import CODE_DIR
 
-# Directory to copy files during make stage.
-LOCAL_INSTANCE = '_local_instance'
-EXCLUDED_RSYNC = ['info.json', 'log.txt']
-
-def rsync_cmd(src, dest, excludes=[]):
-    """
-    Generate command to recursively sync the contents of `src` to `dest`.
+# Job metadata files (at the top of the job directory) that are not copied
+# to or from the make stage's workspace.
+EXCLUDED_FILES = ['info.json', 'log.txt*', 'lease.json', 'interesting.jsonl']
+
+# The most AFIs to ask about in one `describe-fpga-images` call, and the
+# states that jobs move to when their AFIs are done (by AFI status code).
+AFI_BATCH_SIZE = 50
+AFI_DONE_STATES = {
+    'available': state.HLS_FINISH,
+    'failed': state.FAIL,
+    'unavailable': state.FAIL,
+}
+
+def sdaccel_env(task):
+    """Get the environment set up by the AWS FPGA repository's SDAccel
+    setup script.
     """
-    cmd = ['rsync']
-
-    # Add excluded files.
-    for ex in excludes:
-        cmd.extend(['--exclude', ex])
-
-    cmd.extend([
-        '-zavh',
-        os.path.join(src, ''), # Add a trailing slash so rsync sync the contents of src.
-        dest,
-    ])
-
-    return cmd
+    repo = os.environ.get('AWS_FPGA_REPO_DIR')
+    if not repo:
+        raise WorkError('AWS_FPGA_REPO_DIR is not set')
+    return setup_env(task, os.path.join(repo, 'sdaccel_setup.sh'), repo)
 
 def stage_after_make(task):
     """Make stage can transition into three different stages depending on the
@@ -47,10 +53,10 @@ def stage_after_make(task):
 def stage_f1_make(db, config):
     """Make F1: Run make command on AWS F1. Done in four steps:
 
-    1. Copy the code files to local work directory.
+    1. Copy the code files to a local workspace (see `Workspace`).
     2. Setup AWS tools.
     3. Run make command.
-    4. Copy the built files back to the instance directory.
+    4. Copy the new and changed files back to the instance directory.
 
     Assumes that at the end of the make command, work equivalent to the
     stage_hls is done, i.e., either estimation data has been generated or a
@@ -58,31 +64,36 @@ def stage_f1_make(db, config):
     """
 
     prefix = config["HLS_COMMAND_PREFIX"]
-    with work(db, state.MAKE, state.MAKE_PROGRESS, stage_after_make) as task:
+    admission = make_admission(db, config)
+    cores = make_cores(db, config)
+    select = admission.fits if admission else None
+    with work(db, state.MAKE, state.MAKE_PROGRESS, stage_after_make,
+              select) as task:
         task_config(task, config)
 
-        # Create a local working directory for the job.
+        # Hardware builds happen in a local workspace, if there is room.
         work_dir = task.dir
-
-        # Copy the task code files to local directory
+        workspace = None
         if task['mode'] == modes_f1.HW:
-            work_dir = os.path.abspath(os.path.join(LOCAL_INSTANCE, task.job['name']))
-            os.makedirs(work_dir, exist_ok=True)
-            task.run(
-                rsync_cmd(task.dir, work_dir),
-                cwd=os.getcwd(),
-                timeout=600,
+            workspace = Workspace.create(
+                task.dir, config['SCRATCH_ROOT'], task.job['name'],
+                EXCLUDED_FILES, config['SCRATCH_MIN_FREE'],
+                config['SCRATCH_HARDLINK'],
             )
+            if workspace:
+                work_dir = workspace.path
+                task.log('workspace {}: {}'.format(work_dir, ', '.join(
+                    '{} {}'.format(n, method)
+                    for method, n in sorted(workspace.counts.items())
+                ) or 'empty'))
+            else:
+                task.log('not enough space in {}; building in place'.format(
+                    config['SCRATCH_ROOT']
+                ))
 
         try:
             # Get the AWS platform ID for F1 builds.
-            platform_script = (
-                'cd $AWS_FPGA_REPO_DIR; '
-                'source ./sdaccel_setup.sh > /dev/null; '
-                'echo $AWS_PLATFORM; '
-            )
-            proc = task.run([platform_script], capture=True, shell=True)
-            aws_platform = proc.stdout.decode('utf8').strip()
+            aws_platform = sdaccel_env(task).get('AWS_PLATFORM', '')
 
             make = [
                 'make',
@@ -100,30 +111,39 @@ def stage_f1_make(db, config):
             update_make_conf(make_cmd, task, db, config)
 
             # Run the make target
-            task.run(
+            run_make(
+                task,
                 make_cmd,
+                admission,
+                cores,
                 timeout=config["SYNTHESIS_TIMEOUT"],
                 cwd=os.path.join(work_dir, CODE_DIR),
             )
 
-        finally:
-            if task['mode'] == modes_f1.HW:
-                # Copy built files back to the job directory.
-                task.run(
-                    rsync_cmd(work_dir, task.dir, EXCLUDED_RSYNC),
-                    timeout=1200,
-                    cwd=os.getcwd()
-                )
+            # Hardware builds are cached once their AFI is ready.
+            build_cache = BuildCache.open(db, config)
+            if build_cache and task['mode'] != modes_f1.HW:
+                build_cache.store(task, stage_after_make(task))
 
-                # Remove the local instance directory after make is done.
-                shutil.rmtree(work_dir)
+        finally:
+            if workspace:
+                # Copy built files back to the job directory, then remove
+                # the workspace.
+                try:
+                    copied = workspace.copy_back()
+                    task.log('copied {} files back from workspace'.format(
+                        copied
+                    ))
+                finally:
+                    workspace.remove()
 
 
 def stage_afi(db, config):
-    """Work stage: create the AWS FPGA binary and AFI from the *.xclbin
-    (Xilinx FPGA binary file).
+    """Work stage: create the AWS FPGA binary and start creating the AFI
+    from the *.xclbin (Xilinx FPGA binary file). The job then waits for
+    the AFI in the AFI_PENDING state (see `stage_afi_watch`).
     """
-    with work(db, state.AFI_START, state.AFI, state.HLS_FINISH) as task:
+    with work(db, state.AFI_START, state.AFI, state.AFI_PENDING) as task:
 
         task.run(
             ['rm -rf to_aws *afi_id.txt *.tar *agfi_id.txt manifest.txt'],
@@ -139,63 +159,267 @@ def stage_afi(db, config):
         xclbin_file = os.path.basename(xclbin_file_path[0])
 
         # Generate the AFI and AWS binary.
-        afi_script = (
-            'cur=`pwd` ; '
-            'cd $AWS_FPGA_REPO_DIR ; '
-            'source ./sdaccel_setup.sh > /dev/null ; '
-            'cd $cur/xclbin ; '
-            '$SDACCEL_DIR/tools/create_sdaccel_afi.sh '
-            '-xclbin={} '
-            '-s3_bucket={} '
-            '-s3_dcp_key={} '
-            '-s3_logs_key={}'.format(
-                xclbin_file,
-                config['S3_BUCKET'],
-                config['S3_DCP'],
-                config['S3_LOG'],
-            )
-        )
-        task.run([afi_script], cwd=CODE_DIR, shell=True)
+        env = sdaccel_env(task)
+        afi_cmd = [
+            os.path.join(env.get('SDACCEL_DIR', ''), 'tools',
+                         'create_sdaccel_afi.sh'),
+            '-xclbin={}'.format(xclbin_file),
+            '-s3_bucket={}'.format(config['S3_BUCKET']),
+            '-s3_dcp_key={}'.format(config['S3_DCP']),
+            '-s3_logs_key={}'.format(config['S3_LOG']),
+        ]
+        task.run(afi_cmd, cwd=os.path.join(CODE_DIR, 'xclbin'), env=env)
 
         # Get the AFI ID.
         afi_id_files = glob.glob(os.path.join(xcl_dir, '*afi_id.txt'))
         assert afi_id_files, "Failed to find *afi_id.txt file."
 
         with open(afi_id_files[0]) as f:
-            afi_id = json.loads(f.read())['FpgaImageId']
-
-        # Every 5 minutes, check if the AFI is ready.
-        while True:
-            time.sleep(config['AFI_CHECK_INTERVAL'])
-
-            # Check the status of the AFI.
-            status_string = task.run(
-                ['aws', 'ec2', 'describe-fpga-images',
-                 '--fpga-image-ids', afi_id],
-                cwd=CODE_DIR,
-                capture=True
-            )
-            status_json = json.loads(status_string.stdout)
+            afi_info = json.loads(f.read())
+        task['afi_id'] = afi_info['FpgaImageId']
+        task['agfi_id'] = afi_info.get('FpgaImageGlobalId')
+        task.log('waiting for AFI {}'.format(task['afi_id']))
 
-            # When the AFI becomes available, exit the loop and enter
-            # execution stage.
-            status = status_json['FpgaImages'][0]['State']['Code']
-            task.log('AFI status: {}'.format(status))
-            if status == 'available':
-                break
 
+def describe_afis(afi_ids):
+    """Get the states of some AFIs with a single AWS CLI call. Return a
+    dict mapping AFI IDs to their `State` objects (with a `Code` and
+    maybe a `Message`).
+
+    Raise a `WorkError` if the call fails.
+    """
+    cmd = ['aws', 'ec2', 'describe-fpga-images', '--fpga-image-ids'] + \
+        list(afi_ids)
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, timeout=120)
+    except (OSError, subprocess.TimeoutExpired) as exc:
+        raise WorkError('describe-fpga-images failed: {}'.format(exc))
+    if proc.returncode:
+        raise WorkError('describe-fpga-images failed ({}): {}'.format(
+            proc.returncode, proc.stderr.decode('utf8', 'replace').strip(),
+        ))
+    try:
+        images = json.loads(proc.stdout)['FpgaImages']
+        return {image['FpgaImageId']: image['State'] for image in images}
+    except (ValueError, KeyError, TypeError) as exc:
+        raise WorkError('bad describe-fpga-images output: {}'.format(exc))
+
+
+def _afi_states(afi_ids, suspects=()):
+    """Get the states of any number of AFIs, in batches. If a batch
+    fails (e.g., because one of its AFI IDs is invalid), ask about its
+    AFIs one at a time. The `suspects`, whose checks failed before, are
+    always asked about one at a time so they do not hold up the others.
+    Return the states that could be found and the errors for the others,
+    both as dicts keyed by AFI ID.
+    """
+    states = {}
+    errors = {}
+    for afi_id in suspects:
+        try:
+            states.update(describe_afis([afi_id]))
+        except WorkError as exc:
+            errors[afi_id] = exc.message
+    afi_ids = [a for a in afi_ids if a not in suspects]
+    for i in range(0, len(afi_ids), AFI_BATCH_SIZE):
+        batch = afi_ids[i:i + AFI_BATCH_SIZE]
+        try:
+            states.update(describe_afis(batch))
+            continue
+        except WorkError as exc:
+            if len(batch) == 1:
+                errors[batch[0]] = exc.message
+                continue
+        for afi_id in batch:
+            try:
+                states.update(describe_afis([afi_id]))
+            except WorkError as exc:
+                errors[afi_id] = exc.message
+    return states, errors
+
+
+def stage_afi_watch(db, config):
+    """Work stage: wait for the AFIs of all the jobs in the AFI_PENDING
+    state, checking on all of them with batched AWS CLI calls. Jobs
+    whose AFIs become available move on to execution.
+
+    Checks start AFI_CHECK_MIN_INTERVAL seconds apart and back off to
+    AFI_CHECK_INTERVAL while nothing changes, or when the checks fail.
+    Jobs without an AFI ID to check on fail, as do jobs whose AFI
+    cannot be checked AFI_CHECK_MAX_ERRORS times in a row.
+    """
+    min_interval = config['AFI_CHECK_MIN_INTERVAL']
+    interval = min_interval
+    last_codes = {}
+    error_counts = {}
+
+    while True:
+        jobs = {}
+        for job in db.jobs(state.AFI_PENDING):
+            if job.get('afi_id'):
+                jobs[job['afi_id']] = job
+            else:
+                db.log(job['name'], 'no AFI ID to wait for')
+                db.transition(job['name'], state.AFI_PENDING, state.FAIL)
+        if not jobs:
+            interval = min_interval
+            db.wait(state.AFI_PENDING, config['AFI_CHECK_INTERVAL'])
+            continue
+
+        time.sleep(interval)
+        try:
+            changed = _check_afis(db, config, jobs, last_codes,
+                                  error_counts)
+        except Exception:
+            # Keep watching the other jobs.
+            traceback.print_exc()
+            changed = False
+
+        if changed:
+            interval = min_interval
+        else:
+            interval = min(interval * 2, config['AFI_CHECK_INTERVAL'])
 
-def stage_f1_fpga_execute(db, config):
-    """Work stage: upload bitstream to the FPGA controller, run the
-    program, and output the results.
 
-    This stage currently assumes we want to execute on a Xilinx Zynq
-    board, which is accessible via SSH. We require `sshpass` to provide
-    the password for the board (because the OS that comes with ZedBoards
-    hard-codes the root password as root---not terribly secure, so the
-    board should clearly not be on a public network).
+def _check_afis(db, config, jobs, last_codes, error_counts):
+    """Check on the AFIs of the jobs waiting for them (a dict keyed by
+    AFI ID), logging status changes, and move the jobs whose AFIs are
+    done along. `last_codes` holds the last status code logged for each
+    AFI, and `error_counts` the number of checks in a row that failed
+    for each. Return whether any AFI is done.
+    """
+    states, errors = _afi_states(
+        sorted(jobs),
+        [a for a in sorted(jobs) if last_codes.get(a) == 'error'],
+    )
+
+    changed = False
+    for afi_id, job in jobs.items():
+        if afi_id in errors:
+            if last_codes.get(afi_id) != 'error':
+                db.log(job['name'], errors[afi_id])
+            last_codes[afi_id] = 'error'
+            error_counts[afi_id] = error_counts.get(afi_id, 0) + 1
+            if error_counts[afi_id] >= config['AFI_CHECK_MAX_ERRORS']:
+                db.log(job['name'], 'giving up on AFI {} after {} failed '
+                       'checks: {}'.format(afi_id, error_counts[afi_id],
+                                           errors[afi_id]))
+                del last_codes[afi_id]
+                del error_counts[afi_id]
+                db.transition(job['name'], state.AFI_PENDING, state.FAIL)
+            continue
+        error_counts.pop(afi_id, None)
+
+        afi_state = states.get(afi_id, {})
+        code = afi_state.get('Code', 'unknown')
+        if last_codes.get(afi_id) != code:
+            db.log(job['name'], 'AFI status: {}{}'.format(
+                code,
+                ' ({})'.format(afi_state['Message'])
+                if afi_state.get('Message') else '',
+            ))
+        last_codes[afi_id] = code
+        if code not in AFI_DONE_STATES:
+            continue
+
+        # The AFI is done, so the build is complete.
+        changed = True
+        del last_codes[afi_id]
+        next_state = AFI_DONE_STATES[code]
+        build_cache = BuildCache.open(db, config)
+        if build_cache and next_state == state.HLS_FINISH:
+            build_cache.store(JobTask(db, job), next_state)
+        db.transition(job['name'], state.AFI_PENDING, next_state)
+    return changed
+
+
+def _agfi_id(task):
+    """Get the global ID of a job's AFI (the one to load onto an FPGA),
+    or None if it does not have one.
+    """
+    if task.job.get('agfi_id'):
+        return task['agfi_id']
+    for path in glob.glob(os.path.join(task.code_dir, 'xclbin',
+                                       '*afi_id.txt')):
+        try:
+            with open(path) as f:
+                agfi_id = json.load(f).get('FpgaImageGlobalId')
+        except (IOError, ValueError, AttributeError):
+            continue
+        if agfi_id:
+            return agfi_id
+    return None
+
+def _is_hw(entry, running):
+    return entry['mode'] == modes_f1.HW and not entry['skipexec']
+
+def _is_emu(entry, running):
+    return not _is_hw(entry, running)
+
+def _run_on_slot(task, config, pool, slot):
+    """Run a hardware job on an FPGA slot. Clear the slot and load the
+    job's AFI into it first, unless (with `FPGA_REUSE_AFI`) it is
+    already loaded.
     """
-    with work(db, state.HLS_FINISH, state.RUN, state.DONE) as task:
+    task['fpga_slot'] = slot
+    task.log('running on FPGA slot {}'.format(slot))
+
+    agfi_id = _agfi_id(task)
+    if config['FPGA_REUSE_AFI'] and agfi_id and \
+            pool.loaded.get(slot) == agfi_id:
+        pool.record_reuse(slot)
+        task.log('AFI {} is already loaded; skipped clearing and loading '
+                 'it (saved about {:.1f} s)'.format(agfi_id, pool.load_time))
+    else:
+        # Run fpga cleanup command, then load the AFI.
+        pool.record_load(slot, None, None)
+        start = time.time()
+        cleanup_cmd = ['sudo', 'fpga-clear-local-image', '-S', str(slot)]
+        task.run(cleanup_cmd, cwd=CODE_DIR, timeout=600)
+        if agfi_id:
+            load_cmd = ['sudo', 'fpga-load-local-image',
+                        '-S', str(slot), '-I', agfi_id]
+            task.run(load_cmd, cwd=CODE_DIR, timeout=600)
+        pool.record_load(slot, agfi_id, time.time() - start)
+
+    # sudo starts from a clean environment, so pass along everything
+    # that the XRT setup script sets.
+    env = setup_env(task, config['XRT_SETUP'], clean=True)
+    env['FPGA_SLOT'] = str(slot)
+    exe_cmd = sudo_env(env) + ['./{}'.format(config['EXECUTABLE_NAME'])]
+    try:
+        task.run(exe_cmd, cwd=CODE_DIR, timeout=9000)
+    except WorkError:
+        # The program may have left the FPGA in a bad state.
+        pool.record_load(slot, None, None)
+        raise
+
+def _prefer_loaded(pool, slot, config):
+    """Get a `prefer` function for acquiring the jobs that use the AFI
+    loaded in a slot, or None if there should be no preference: when
+    nothing is loaded, or when `FPGA_REUSE_LIMIT` jobs in a row have
+    already reused it (so other jobs do not wait forever).
+    """
+    agfi_id = pool.loaded.get(slot)
+    if not (config['FPGA_REUSE_AFI'] and agfi_id) or \
+            pool.reuses.get(slot, 0) >= config['FPGA_REUSE_LIMIT']:
+        return None
+    return lambda entry: entry['agfi'] == agfi_id
+
+def stage_f1_fpga_execute(db, config, select=None, slot=None, prefer=None):
+    """Work stage: load the bitstream onto an FPGA, run the program, and
+    output the results.
+
+    Hardware runs take one of the instance's FPGA slots (see
+    `FPGA_SLOTS`) for themselves, unless a `slot` is given: the slot is
+    cleared, the job's AFI is loaded into it, and the program runs with
+    the slot number in the `FPGA_SLOT` environment variable. Emulation
+    runs need no slot. If given, `select` limits the jobs this takes and
+    `prefer` picks the ones to take first (see `JobDB.acquire`).
+    """
+    with work(db, state.HLS_FINISH, state.RUN, state.DONE, select,
+              prefer) as task:
 
         # Do nothing in this stage if we're just running estimation.
         if task['config'].get('estimate') or task['config'].get('skipexec'):
@@ -205,19 +429,32 @@ def stage_f1_fpga_execute(db, config):
         # On F1, use the run either the real hardware-augmented binary or the
         # emulation executable.
         if task['mode'] == modes_f1.HW:
-            # Run fpga cleanup command
-            cleanup_cmd = ['sudo', 'fpga-clear-local-image', '-S', '0']
-            task.run(cleanup_cmd, cwd=CODE_DIR, timeout=600)
-
-            exe_cmd = ['sudo', 'sh', '-c',
-                       'source /opt/xilinx/xrt/setup.sh ; ./{}'.format(config['EXECUTABLE_NAME'])]
+            pool = fpga_slots(db, config)
+            if slot is None:
+                with pool.slot() as free_slot:
+                    _run_on_slot(task, config, pool, free_slot)
+            else:
+                _run_on_slot(task, config, pool, slot)
         else:
-            exe_cmd = [
-                'sh', '-c',
-                'source $AWS_FPGA_REPO_DIR/sdaccel_setup.sh > /dev/null; '
-                'XCL_EMULATION_MODE={} ./{}'.format(
-                    task['mode'],
-                    config['EXECUTABLE_NAME']
-                )
-            ]
-        task.run(exe_cmd, cwd=CODE_DIR, timeout=9000)
+            env = sdaccel_env(task)
+            env['XCL_EMULATION_MODE'] = task['mode']
+            exe_cmd = ['./{}'.format(config['EXECUTABLE_NAME'])]
+            task.run(exe_cmd, cwd=CODE_DIR, timeout=9000, env=env)
+
+
+def stage_f1_hw_execute(db, config):
+    """Work stage: `stage_f1_fpga_execute` for hardware runs only. The
+    slot is reserved before a job is taken, so jobs that use the AFI
+    already loaded in it can go first.
+    """
+    pool = fpga_slots(db, config)
+    with pool.slot() as slot:
+        stage_f1_fpga_execute(db, config, _is_hw, slot,
+                              _prefer_loaded(pool, slot, config))
+
+
+def stage_f1_emu_execute(db, config):
+    """Work stage: `stage_f1_fpga_execute` for everything but hardware
+    runs (i.e., emulation, and jobs that skip execution).
+    """
+    stage_f1_fpga_execute(db, config, _is_emu)
@@ -4,7 +4,9 @@ import json
 import time
 
 from . import state
-from .stages_common import work, task_config, update_make_conf
+from .stages_common import work, task_config, update_make_conf, run_make
+from .resources import make_admission, make_cores
+from .cache import BuildCache
 from .db import CODE_DIR
 
 # For executing on a Xilinx Zynq board.
@@ -22,8 +24,12 @@ def stage_sdsoc_make(db, config):
     """
 
     prefix = config["HLS_COMMAND_PREFIX"]
+    admission = make_admission(db, config)
+    cores = make_cores(db, config)
+    select = admission.fits if admission else None
 
-    with work(db, state.MAKE, state.MAKE_PROGRESS, state.HLS_FINISH) as task:
+    with work(db, state.MAKE, state.MAKE_PROGRESS, state.HLS_FINISH,
+              select) as task:
         task_config(task, config)
 
         # Simple make invocation for SDSoC.
@@ -43,12 +49,19 @@ def stage_sdsoc_make(db, config):
         update_make_conf(make_cmd, task, db, config)
 
         # Run the make target
-        task.run(
+        run_make(
+            task,
             make_cmd,
+            admission,
+            cores,
             timeout=config["SYNTHESIS_TIMEOUT"],
             cwd=CODE_DIR,
         )
 
+        build_cache = BuildCache.open(db, config)
+        if build_cache:
+            build_cache.store(task, state.HLS_FINISH)
+
 
 def stage_zynq_fpga_execute(db, config):
     """Work stage: upload bitstream to the FPGA controller, run the
@@ -2,10 +2,12 @@ import argparse
 import curio
 import os
 import sys
+import threading
 import time
 
 from . import worker
-from .db import JobDB
+from . import inotify
+from .db import open_db
 from flask.config import Config
 
 
@@ -34,16 +36,18 @@ class WorkProc:
         self.config.from_pyfile('polyphemus.cfg', silent=True)
 
         # Create the database.
-        self.db = db or JobDB(self.basedir)
+        self.db = db or open_db(self.basedir, self.config)
 
     def start(self, stages_conf=None):
         """Create and start the worker threads. If stages_conf is None, create the
         default workers for the given toolchain. If stages_confg is a list of
         strings in worker.KNOWN_STAGES then create workers mapping to those.
+        Raise a ValueError if those stages cannot run together.
         """
         if stages_conf is None:
             stages = worker.default_work_stages(self.config)
         else:
+            worker.check_stages(stages_conf)
             stages = [worker.KNOWN_STAGES[stage] for stage in stages_conf]
 
         print(stages)
@@ -60,9 +64,9 @@ class WorkProc:
             job_name = line.decode('utf8').strip()
             print(job_name)
 
-            # Just notify the database that something changed.
-            with self.db.cv:
-                self.db.cv.notify_all()
+            # Re-read the job so the database's index (and any waiting
+            # workers) pick up the change.
+            self.db.refresh(job_name)
 
     def serve(self):
         """Start listening on a Unix domain socket for incoming
@@ -81,13 +85,31 @@ class WorkProc:
 
     def poll(self):
         """Continously poll the work directory for open jobs.
+
+        Where inotify is available (and `WATCH_JOBS` is enabled), a
+        watcher thread refreshes jobs as soon as they change, and the
+        polling is only a slow fallback every `POLL_FALLBACK_INTERVAL`
+        seconds. Otherwise, waiting workers are woken up every 2 seconds
+        to look for newly created jobs. Every `REINDEX_INTERVAL` seconds,
+        the database's state index is also refreshed to pick up state
+        changes made by other processes.
         """
+        interval = 2
+        if self.config['WATCH_JOBS'] and inotify.available():
+            print('Watching for job changes.')
+            threading.Thread(target=self.db.watch, daemon=True).start()
+            interval = self.config['POLL_FALLBACK_INTERVAL']
+
+        last_reindex = time.time()
         try:
             while True:
-                with self.db.cv:
-                    self.db.cv.notify_all()
+                if time.time() - last_reindex >= self.config['REINDEX_INTERVAL']:
+                    self.db.reindex()
+                    last_reindex = time.time()
+                else:
+                    self.db.notify_all()
 
-                time.sleep(2)
+                time.sleep(interval)
 
         except KeyboardInterrupt:
             print ("Shutting down worker.")
@@ -134,7 +156,10 @@ if __name__ == '__main__':
 
 
     p = WorkProc(INSTANCE_DIR)
-    p.start(opts.stages)
+    try:
+        p.start(opts.stages)
+    except ValueError as exc:
+        parser.error(str(exc))
 
     if opts.poll:
         print('Starting worker in poll mode.')
@@ -0,0 +1,187 @@
+import errno
+import fcntl
+import fnmatch
+import os
+import shutil
+import stat
+
+# The Linux ioctl that makes a file share another's data (a "reflink").
+FICLONE = 0x40049409
+
+# Errors meaning that a reflink or hard link is impossible here, so we
+# should fall back to the next way of copying.
+_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                errno.EPERM, errno.EMLINK, errno.ENOSYS)
+
+
+def _reflink(src, dst):
+    """Try to make `dst` a copy-on-write clone of `src`. Return False if
+    the filesystem cannot do that.
+    """
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError as exc:
+            if exc.errno not in _UNSUPPORTED:
+                raise
+            return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def clone_file(src, dst, hardlink=False):
+    """Copy a file as cheaply as the filesystem allows: as a reflink if
+    possible, then (if `hardlink` is set) as a hard link, and otherwise
+    as a plain copy. Return the method used: 'cloned', 'linked', or
+    'copied'.
+
+    `shutil.copytree` can use this as its `copy_function`.
+    """
+    if _reflink(src, dst):
+        return 'cloned'
+    os.unlink(dst)
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return 'linked'
+        except OSError as exc:
+            if exc.errno not in _UNSUPPORTED:
+                raise
+    shutil.copy2(src, dst)
+    return 'copied'
+
+
+def _excluded(name, exclude):
+    return any(fnmatch.fnmatch(name, pat) for pat in exclude)
+
+
+def _walk(top, exclude):
+    """Generate the paths (relative to `top`) of the directories, files,
+    and symlinks in a tree, skipping the entries directly in `top` whose
+    names match the `exclude` patterns (anything deeper is kept).
+    Directories come before their contents.
+    """
+    for dirpath, dirnames, filenames in os.walk(top):
+        if dirpath == top:
+            dirnames[:] = [d for d in dirnames if not _excluded(d, exclude)]
+            filenames = [f for f in filenames if not _excluded(f, exclude)]
+        rel = os.path.relpath(dirpath, top)
+        for name in sorted(dirnames) + sorted(filenames):
+            yield os.path.normpath(os.path.join(rel, name))
+
+
+def _signature(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def tree_size(top, exclude=()):
+    """Get the total size of the files in a tree.
+    """
+    total = 0
+    for rel in _walk(top, exclude):
+        try:
+            st = os.lstat(os.path.join(top, rel))
+        except OSError:
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            total += st.st_size
+    return total
+
+
+class Workspace:
+    """A private copy of a job directory in which to build, under a
+    scratch root on fast local storage.
+
+    Files are copied in with reflinks or hard links where possible, so
+    setting up the workspace takes next to no time or space. Afterward,
+    only the files that the build created or changed are copied back.
+    Top-level entries of the job directory matching the `exclude`
+    patterns (i.e., the job's own metadata) are left alone both ways.
+    """
+    def __init__(self, src, path, exclude=(), hardlink=True):
+        self.src = src
+        self.path = path
+        self.exclude = exclude
+        self.hardlink = hardlink
+
+        # The state of each file just after it was copied in, by
+        # relative path, and the number of files copied in by each
+        # method (see `clone_file`).
+        self.snapshot = {}
+        self.counts = {}
+
+    @classmethod
+    def create(cls, src, root, name, exclude=(), min_free=0, hardlink=True):
+        """Set up a workspace for the job directory `src` at `root/name`.
+        Return None if the scratch root would have less than `min_free`
+        GiB free after a full copy of the job.
+        """
+        os.makedirs(root, exist_ok=True)
+        needed = tree_size(src, exclude) + min_free * 1024 ** 3
+        if shutil.disk_usage(root).free < needed:
+            return None
+
+        ws = cls(src, os.path.abspath(os.path.join(root, name)), exclude,
+                 hardlink)
+        if os.path.exists(ws.path):
+            shutil.rmtree(ws.path)
+        os.makedirs(ws.path)
+        ws._populate()
+        return ws
+
+    def _populate(self):
+        """Copy the job directory into the workspace.
+        """
+        for rel in _walk(self.src, self.exclude):
+            src = os.path.join(self.src, rel)
+            dst = os.path.join(self.path, rel)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+            elif os.path.isdir(src):
+                os.mkdir(dst)
+                shutil.copystat(src, dst)
+            else:
+                method = clone_file(src, dst, self.hardlink)
+                self.counts[method] = self.counts.get(method, 0) + 1
+            self.snapshot[rel] = _signature(os.lstat(dst))
+
+    def copy_back(self):
+        """Copy the files that are new or changed in the workspace back
+        to the job directory. Return the number of files copied.
+        """
+        copied = 0
+        for rel in _walk(self.path, self.exclude):
+            src = os.path.join(self.path, rel)
+            dst = os.path.join(self.src, rel)
+            st = os.lstat(src)
+            if self.snapshot.get(rel) == _signature(st):
+                continue
+
+            if os.path.isdir(src) and not os.path.islink(src):
+                os.makedirs(dst, exist_ok=True)
+                continue
+
+            # A hard-linked file that was modified in place is already
+            # up to date.
+            try:
+                if os.path.samefile(src, dst):
+                    continue
+            except OSError:
+                pass
+
+            # Replace the old file all at once. The workspace is about to
+            # be removed, so it can share the new file's data.
+            tmp = os.path.join(os.path.dirname(dst),
+                               '.{}.tmp'.format(os.path.basename(dst)))
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), tmp)
+            else:
+                clone_file(src, tmp, hardlink=True)
+            os.replace(tmp, dst)
+            copied += 1
+        return copied
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)